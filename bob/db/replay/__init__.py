@@ -7,7 +7,12 @@
 """
 
 from .query import Database
-from .models import Client, File, Protocol, RealAccess, Attack
+from .models import Client, File, Protocol, RealAccess, Attack, ListFile
+from .index import MetadataIndex
+from .framecache import FrameCache
+from .loader import LoadResult, Prefetcher
+from .records import FileRecord
+from .faces import FaceLocationCache, FaceLocationStore, align_bbx, align_bbx_batch, crop_faces
 
 def get_config():
   """Returns a string containing the configuration information.
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Measures the latency of typical queries to the database.
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+
+QUERIES = (
+    dict(),
+    dict(cls='real'),
+    dict(cls='enroll'),
+    dict(cls='attack', protocol='print'),
+    dict(groups='devel'),
+    dict(cls='attack', groups='test', support='hand', light='adverse'),
+    dict(cls='attack', support='hand', device='mobile', sample_type='video',
+         light='adverse'),
+    dict(cls=('real', 'attack'), protocol=('highdef', 'video')),
+    dict(cls=('enroll', 'real', 'attack'), groups=('train', 'devel')),
+)
+"""Mix of :py:meth:`.Database.objects` queries used for benchmarking"""
+
+
+def time_queries(db, queries, repetitions):
+  """Runs each query ``repetitions`` times and returns the average latency
+  of every query (in seconds) and the number of objects it returned."""
+
+  retval = []
+  for query in queries:
+    start = time.time()
+    for k in range(repetitions):
+      n = len(db.objects(**query))
+    retval.append(((time.time() - start) / repetitions, n))
+  return retval
+
+
+def _format_query(query):
+  """Returns a compact string representation of a query"""
+
+  if not query:
+    return '(defaults)'
+  return ', '.join('%s=%s' % (k, query[k]) for k in sorted(query))
+
+
+def drop_indexes(sqlite_file):
+  """Drops all secondary indexes declared by the schema from a SQLite file,
+  to measure queries against a database created before they existed.
+  Implicit indexes of primary keys and unique constraints are kept."""
+
+  from .models import Base
+
+  names = [index.name for table in Base.metadata.sorted_tables
+           for index in table.indexes]
+
+  connection = sqlite3.connect(sqlite_file)
+  try:
+    for name in names:
+      connection.execute('DROP INDEX IF EXISTS "%s"' % name)
+    connection.commit()
+  finally:
+    connection.close()
+
+# Driver API
+# ==========
+
+
+def benchmark(args):
+  """Measures the per-query latency of the database query modes and layouts"""
+
+  from .query import Database, QUERY_MODES
+
+  modes = args.mode or QUERY_MODES
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  # databases to compare: (name, SQLite file)
+  if args.sqlite_files:
+    sources = [(os.path.splitext(os.path.basename(k))[0], k)
+               for k in args.sqlite_files]
+  else:
+    sources = [('', Database().m_sqlite_file)]
+
+  tmpdir = None
+  if args.indexes:
+    tmpdir = tempfile.mkdtemp()
+    unindexed = []
+    for i, (name, sqlite_file) in enumerate(sources):
+      copy = os.path.join(tmpdir, '%d.sql3' % i)
+      shutil.copy(sqlite_file, copy)
+      drop_indexes(copy)
+      unindexed.append(('%s-noidx' % name if name else 'noidx', copy))
+    sources = [k for pair in zip(unindexed, sources) for k in pair]
+
+  for name, sqlite_file in sources:
+    output.write("'%s': %d bytes\n" % (name or sqlite_file,
+                                        os.path.getsize(sqlite_file)))
+
+  # configurations to compare: (label, query mode, SQLite file)
+  configurations = []
+  for mode in modes:
+    for name, sqlite_file in sources:
+      if mode == 'index' and name.endswith('noidx'):
+        continue  # does not run SQL queries after set-up
+      label = '%s/%s' % (name, mode) if name else mode
+      configurations.append((label, mode, sqlite_file))
+
+  try:
+    results = {}
+    for label, mode, sqlite_file in configurations:
+      db = Database(mode=mode, sqlite_file=sqlite_file)
+      start = time.time()
+      db.objects()  # first query: includes connection and index set-up
+      setup = time.time() - start
+      output.write("'%s': first query took %.2f ms\n" % (label, 1000 * setup))
+      results[label] = time_queries(db, QUERIES, args.repetitions)
+      db.m_session.close()
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir)
+
+  labels = [k[0] for k in configurations]
+  width = max(12, max(len(k) for k in labels) + 5)
+
+  output.write('\n%-70s %6s' % ('query', 'files'))
+  for label in labels:
+    output.write(' %*s' % (width, '%s (ms)' % label))
+  output.write('\n')
+
+  for i, query in enumerate(QUERIES):
+    n = results[labels[0]][i][1]
+    output.write('%-70s %6d' % (_format_query(query), n))
+    for label in labels:
+      output.write(' %*.3f' % (width, 1000 * results[label][i][0]))
+    output.write('\n')
+
+  return 0
+
+
+def add_command(subparsers):
+  """Add specific subcommands that the action "benchmark" can use"""
+
+  from argparse import SUPPRESS
+  from .query import QUERY_MODES
+
+  parser = subparsers.add_parser('benchmark', help=benchmark.__doc__)
+
+  parser.add_argument('-m', '--mode', dest="mode", action='append',
+                      choices=QUERY_MODES, help="query mode to benchmark; may be given multiple times (defaults to all available modes)")
+  parser.add_argument('-n', '--repetitions', dest="repetitions", default=20,
+                      type=int, help="number of times each query is repeated (defaults to %(default)s)")
+  parser.add_argument('-f', '--sqlite-file', dest="sqlite_files", action='append',
+                      metavar='FILE', help="SQLite file to benchmark instead of the installed database; may be given multiple times to compare databases (e.g., created with and without 'create --compact')")
+  parser.add_argument('-I', '--compare-indexes', dest="indexes",
+                      default=False, action='store_true', help="also times SQL queries against a copy of the database without secondary indexes, as created by older versions of this package")
+  parser.add_argument('--self-test', dest="selftest", default=False,
+                      action='store_true', help=SUPPRESS)
+
+  parser.set_defaults(func=benchmark, mode=None)  # action
@@ -26,6 +26,9 @@ def checkfiles(args):
       cls=args.cls,
       light=args.light,
       clients=args.client,
+      device=args.device,
+      sample_type=args.sample_type,
+      sample_device=args.sample_device,
   )
 
   # go through all files, check if they are available on the filesystem
@@ -75,6 +78,9 @@ def add_command(subparsers):
   parser.add_argument('-c', '--class', dest="cls", default='', help="if given, limits the check to a particular subset of the data that corresponds to the given class (defaults to '%(default)s')", choices=('real', 'attack', 'enroll'))
   parser.add_argument('-g', '--group', dest="group", default='', help="if given, this value will limit the check to those files belonging to a particular protocolar group. (defaults to '%(default)s')", choices=db.groups())
   parser.add_argument('-s', '--support', dest="support", default='', help="if given, this value will limit the check to those files using this type of attack support. (defaults to '%(default)s')", choices=db.attack_supports())
+  parser.add_argument('-D', '--device', dest="device", default='', help="if given, this value will limit the check to those files using this type of attack device. (defaults to '%(default)s')", choices=db.attack_devices())
+  parser.add_argument('-t', '--sample-type', dest="sample_type", default='', help="if given, this value will limit the check to those files which attacks were made from this type of sample. (defaults to '%(default)s')", choices=db.attack_sample_types())
+  parser.add_argument('-S', '--sample-device', dest="sample_device", default='', help="if given, this value will limit the check to those files which attack samples were taken with this device. (defaults to '%(default)s')", choices=db.attack_sampling_devices())
   parser.add_argument('-x', '--protocol', dest="protocol", default='', help="if given, this value will limit the check to those files for a given protocol. (defaults to '%(default)s')", choices=protocols)
   parser.add_argument('-l', '--light', dest="light", default='', help="if given, this value will limit the check to those files shot under a given lighting. (defaults to '%(default)s')", choices=db.lights())
   parser.add_argument('-C', '--client', dest="client", default=None, type=int, help="if given, limits the dump to a particular client (defaults to '%(default)s')", choices=clients)
@@ -7,20 +7,93 @@
 """
 
 import os
+import sys
 import fnmatch
+import hashlib
 
 from .models import *
 
 
+REAL_LISTS = (
+    'real-train.txt',
+    'real-devel.txt',
+    'real-test.txt',
+    'recognition-train.txt',
+    'recognition-devel.txt',
+    'recognition-test.txt',
+)
+"""Lists of real-accesses (RCD) that define the files of the database"""
+
+ATTACK_LISTS = (
+    'attack-grandtest-allsupports-train.txt',
+    'attack-grandtest-allsupports-devel.txt',
+    'attack-grandtest-allsupports-test.txt',
+)
+"""Lists of attacks (RAD) that define the files of the database"""
+
+
+LIST_PATTERNS = (
+    'clients.txt',
+    'real-*.txt',
+    'recognition-*.txt',
+    'attack-*-allsupports-*.txt',
+)
+"""Patterns matching all file lists in a protocol directory"""
+
+
+def read_list(filename):
+  """Yields the non-empty, stripped lines of a file list"""
+
+  for fname in open(filename, 'rt'):
+    s = fname.strip()
+    if not s:
+      continue  # emtpy line
+    yield s
+
+
+def read_clients(protodir):
+  """Returns a list of (id, set) tuples for all clients in the database"""
+
+  retval = []
+  for client in read_list(os.path.join(protodir, 'clients.txt')):
+    s = client.split(' ', 2)
+    retval.append((int(s[0]), s[1]))
+  return retval
+
+
+def parse_real_filename(f):
+  """Parses the RCD filename and break it in the relevant chunks."""
+
+  v = os.path.splitext(os.path.basename(f))[0].split('_')
+  client_id = int(v[0].replace('client', ''))
+  path = os.path.splitext(f)[0]  # keep only the filename stem
+  purpose = v[3]
+  light = v[4]
+  if len(v) == 6:
+    take = int(v[5])  # authentication session
+  else:
+    take = 1  # enrollment session
+  return [client_id, path, light], [purpose, take]
+
+
+def parse_attack_filename(f):
+  """Parses the RAD filename and break it in the relevant chunks."""
+
+  v = os.path.splitext(os.path.basename(f))[0].split('_')
+  attack_device = v[1]  # print, mobile or highdef
+  client_id = int(v[2].replace('client', ''))
+  path = os.path.splitext(f)[0]  # keep only the filename stem
+  sample_device = v[4]  # highdef or mobile
+  sample_type = v[5]  # photo or video
+  light = v[6]
+  attack_support = f.split('/')[-2]
+  return [client_id, path, light], [attack_support, attack_device, sample_type, sample_device]
+
+
 def add_clients(session, protodir, verbose):
   """Add clients to the replay attack database."""
 
-  for client in open(os.path.join(protodir, 'clients.txt'), 'rt'):
-    s = client.strip().split(' ', 2)
-    if not s:
-      continue  # empty line
-    id = int(s[0])
-    set = s[1]
+  for id, set in read_clients(protodir):
     if verbose:
       print("Adding client %d on '%s' set..." % (id, set))
     session.add(Client(id, set))
@@ -29,79 +102,109 @@ def add_clients(session, protodir, verbose):
 def add_real_lists(session, protodir, verbose):
   """Adds all RCD filelists"""
 
+  clients = dict((k.id, k) for k in session.query(Client))
+
   def add_real_list(session, filename):
     """Adds an RCD filelist and materializes RealAccess'es."""
 
-    def parse_real_filename(f):
-      """Parses the RCD filename and break it in the relevant chunks."""
-
-      v = os.path.splitext(os.path.basename(f))[0].split('_')
-      client_id = int(v[0].replace('client', ''))
-      path = os.path.splitext(f)[0]  # keep only the filename stem
-      purpose = v[3]
-      light = v[4]
-      if len(v) == 6:
-        take = int(v[5])  # authentication session
-      else:
-        take = 1  # enrollment session
-      return [client_id, path, light], [purpose, take]
-
-    for fname in open(filename, 'rt'):
-      s = fname.strip()
-      if not s:
-        continue  # emtpy line
+    for s in read_list(filename):
       filefields, realfields = parse_real_filename(s)
-      filefields[0] = session.query(Client).filter(Client.id == filefields[0]).one()
+      filefields[0] = clients[filefields[0]]
       file = File(*filefields)
       session.add(file)
       realfields.insert(0, file)
       session.add(RealAccess(*realfields))
 
-  add_real_list(session, os.path.join(protodir, 'real-train.txt'))
-  add_real_list(session, os.path.join(protodir, 'real-devel.txt'))
-  add_real_list(session, os.path.join(protodir, 'real-test.txt'))
-  add_real_list(session, os.path.join(protodir, 'recognition-train.txt'))
-  add_real_list(session, os.path.join(protodir, 'recognition-devel.txt'))
-  add_real_list(session, os.path.join(protodir, 'recognition-test.txt'))
+  for filename in REAL_LISTS:
+    add_real_list(session, os.path.join(protodir, filename))
 
 
 def add_attack_lists(session, protodir, verbose):
   """Adds all RAD filelists"""
 
+  clients = dict((k.id, k) for k in session.query(Client))
+
   def add_attack_list(session, filename):
     """Adds an RAD filelist and materializes Attacks."""
 
-    def parse_attack_filename(f):
-      """Parses the RAD filename and break it in the relevant chunks."""
-
-      v = os.path.splitext(os.path.basename(f))[0].split('_')
-      attack_device = v[1]  # print, mobile or highdef
-      client_id = int(v[2].replace('client', ''))
-      path = os.path.splitext(f)[0]  # keep only the filename stem
-      sample_device = v[4]  # highdef or mobile
-      sample_type = v[5]  # photo or video
-      light = v[6]
-      attack_support = f.split('/')[-2]
-      return [client_id, path, light], [attack_support, attack_device, sample_type, sample_device]
-
-    for fname in open(filename, 'rt'):
-      s = fname.strip()
-      if not s:
-        continue  # emtpy line
+    for s in read_list(filename):
       filefields, attackfields = parse_attack_filename(s)
-      filefields[0] = session.query(Client).filter(Client.id == filefields[0]).one()
+      filefields[0] = clients[filefields[0]]
       file = File(*filefields)
       session.add(file)
       attackfields.insert(0, file)
       session.add(Attack(*attackfields))
 
-  add_attack_list(session, os.path.join(protodir, 'attack-grandtest-allsupports-train.txt'))
-  add_attack_list(session, os.path.join(protodir, 'attack-grandtest-allsupports-devel.txt'))
-  add_attack_list(session, os.path.join(protodir, 'attack-grandtest-allsupports-test.txt'))
+  for filename in ATTACK_LISTS:
+    add_attack_list(session, os.path.join(protodir, filename))
 
 
-def define_protocols(session, protodir, verbose):
-  """Defines all available protocols"""
+def bulk_add_lists(session, protodir, verbose):
+  """Adds clients, files, real-accesses and attacks with bulk inserts
+
+  All lists are first parsed into plain rows, with primary keys assigned in
+  the same order as :py:func:`add_real_lists` and :py:func:`add_attack_lists`
+  would do, and then written with one multi-row (executemany) insert per
+  table, bypassing the ORM unit-of-work.
+  """
+
+  from sqlalchemy import func
+
+  clients = [dict(id=id, set=set) for id, set in read_clients(protodir)]
+  known = set(k['id'] for k in clients)
+  known.update(k[0] for k in session.query(Client.id))
+
+  files = []
+  reals = []
+  attacks = []
+  file_id = session.query(func.max(File.id)).scalar() or 0
+  real_id = session.query(func.max(RealAccess.id)).scalar() or 0
+  attack_id = session.query(func.max(Attack.id)).scalar() or 0
+
+  def add_file(filefields):
+    if filefields[0] not in known:
+      raise RuntimeError("File '%s' refers to unknown client %d" %
+                         (filefields[1], filefields[0]))
+    files.append(dict(id=file_id, client_id=filefields[0],
+                      path=filefields[1], light=filefields[2]))
+
+  for filename in REAL_LISTS:
+    for s in read_list(os.path.join(protodir, filename)):
+      filefields, realfields = parse_real_filename(s)
+      file_id += 1
+      add_file(filefields)
+      real_id += 1
+      reals.append(dict(id=real_id, file_id=file_id, purpose=realfields[0],
+                        take=realfields[1]))
+
+  for filename in ATTACK_LISTS:
+    for s in read_list(os.path.join(protodir, filename)):
+      filefields, attackfields = parse_attack_filename(s)
+      file_id += 1
+      add_file(filefields)
+      attack_id += 1
+      attacks.append(dict(id=attack_id, file_id=file_id,
+                          attack_support=attackfields[0],
+                          attack_device=attackfields[1],
+                          sample_type=attackfields[2],
+                          sample_device=attackfields[3]))
+
+  for table, rows in ((Client, clients), (File, files), (RealAccess, reals),
+                      (Attack, attacks)):
+    if verbose:
+      print("Adding %d rows to table '%s'..." % (len(rows),
+                                                 table.__tablename__))
+    if rows:
+      session.execute(table.__table__.insert(), rows)
+
+
+def find_protocols(protodir, verbose):
+  """Finds all protocols defined in the protocol directory
+
+  Returns a dictionary mapping each protocol name to another dictionary,
+  mapping each group name to a tuple with the attack and real-access lists
+  for that group.
+  """
 
   # figures out which protocols to use
   valid = {}
@@ -138,46 +241,222 @@ def define_protocols(session, protodir, verbose):
     if consider:
       valid[s[1]] = files
 
+  return valid
+
+
+def protocol_members(groups, attacks, reals, verbose):
+  """Resolves the lists of a protocol into attack and real-access ids
+
+  Keyword parameters:
+
+  groups
+    A dictionary mapping group names to tuples with the attack and the
+    real-access list of the group, as returned by :py:func:`find_protocols`
+
+  attacks
+    A dictionary mapping file stems to attack identifiers
+
+  reals
+    A dictionary mapping file stems to real-access identifiers
+
+  Returns a tuple with two lists: the attack identifiers and the real-access
+  identifiers listed for the protocol, each one only once. Raises a
+  RuntimeError if a listed file is not in the database.
+  """
+
+  seen = set()
+
+  def resolve(filename, ids, kind):
+    retval = []
+    for fname in read_list(filename):
+      s = os.path.splitext(fname)[0]
+      if s not in ids:
+        raise RuntimeError("Cannot find %s '%s' (listed at '%s') in the database" % (kind, s, filename))
+      if (kind, ids[s]) in seen:
+        continue  # listed twice: associated once
+      seen.add((kind, ids[s]))
+      retval.append(ids[s])
+    return retval
+
+  attack_ids = []
+  real_ids = []
+
+  for grp, flist in groups.items():
+
+    ids = resolve(flist[0], attacks, 'attack')
+    if verbose:
+      print("  -> %5s/%-6s: %d files" % (grp, "attack", len(ids)))
+    attack_ids += ids
+
+    ids = resolve(flist[1], reals, 'real-access')
+    if verbose:
+      print("  -> %5s/%-6s: %d files" % (grp, "real", len(ids)))
+    real_ids += ids
+
+  return attack_ids, real_ids
+
+
+def define_protocols(session, protodir, verbose):
+  """Defines all available protocols"""
+
+  valid = find_protocols(protodir, verbose)
+
+  # maps file stems to attack and real-access identifiers, once
+  session.flush()
+  attacks = dict(session.query(File.path, Attack.id).join(Attack))
+  reals = dict(session.query(File.path, RealAccess.id).join(RealAccess))
+
   for protocol, groups in valid.items():
     if verbose:
       print("Creating protocol '%s'..." % protocol)
 
     # create protocol on the protocol table
     obj = Protocol(name=protocol)
+    session.add(obj)
+    session.flush()  # assigns the protocol identifier
+
+    attack_ids, real_ids = protocol_members(groups, attacks, reals, verbose)
+
+    if attack_ids:
+      session.execute(attacks_protocols.insert(),
+                      [dict(attack_id=k, protocol_id=obj.id) for k in attack_ids])
+    if real_ids:
+      session.execute(realaccesses_protocols.insert(),
+                      [dict(realaccess_id=k, protocol_id=obj.id) for k in real_ids])
+
+
+def list_digests(protodir):
+  """Returns a dictionary mapping the name of each file list in the protocol
+  directory to the SHA-1 digest of its contents"""
+
+  retval = {}
+  for fname in sorted(os.listdir(protodir)):
+    if not any(fnmatch.fnmatch(fname, k) for k in LIST_PATTERNS):
+      continue
+    with open(os.path.join(protodir, fname), 'rb') as f:
+      retval[fname] = hashlib.sha1(f.read()).hexdigest()
+  return retval
+
 
-    for grp, flist in groups.items():
+def record_digests(session, digests):
+  """Replaces the list digests stored in the database"""
 
-      counter = 0
-      for fname in open(flist[0], 'rt'):
-        s = os.path.splitext(fname.strip())[0]
-        q = session.query(Attack).join(File).filter(File.path == s).one()
-        q.protocols.append(obj)
-        counter += 1
+  session.query(ListFile).delete()
+  session.execute(ListFile.__table__.insert(),
+                  [dict(name=k, digest=v) for k, v in sorted(digests.items())])
+
+
+def update_protocols(session, protodir, verbose):
+  """Incrementally updates the protocols of an existing database
+
+  The digests of the file lists in the protocol directory are compared to
+  the ones recorded in the database at its last update. If any of the lists
+  defining clients, files, real-accesses or attacks has changed (or if no
+  digests were recorded), nothing is done and ``False`` is returned: the
+  database must be fully re-created. Otherwise, protocols whose lists have
+  not changed are left untouched, removed protocols are deleted and the
+  association rows of new or modified protocols are added or removed in
+  place. Returns ``True`` in that case.
+  """
+
+  from sqlalchemy import and_, bindparam
+
+  stored = dict(session.query(ListFile.name, ListFile.digest))
+  current = list_digests(protodir)
+
+  def changed(names):
+    return [k for k in names if stored.get(k) != current.get(k)]
+
+  base = changed(('clients.txt',) + REAL_LISTS + ATTACK_LISTS)
+  if not stored or base:
+    if verbose:
+      print("Cannot update incrementally, lists changed: %s" %
+            (', '.join(base) or '(no digests recorded)'))
+    return False
+
+  valid = find_protocols(protodir, verbose)
+  existing = dict((k.name, k) for k in session.query(Protocol))
+
+  for name in sorted(set(existing) - set(valid)):
+    if verbose:
+      print("Removing protocol '%s'..." % name)
+    pid = existing[name].id
+    session.execute(attacks_protocols.delete().where(
+        attacks_protocols.c.protocol_id == pid))
+    session.execute(realaccesses_protocols.delete().where(
+        realaccesses_protocols.c.protocol_id == pid))
+    session.delete(existing[name])
+
+  attacks = None
+  reals = None
+
+  for name, groups in sorted(valid.items()):
+
+    lists = [os.path.basename(k) for v in groups.values() for k in v]
+    if name in existing and not changed(lists):
+      if verbose:
+        print("Protocol '%s' is up-to-date" % name)
+      continue
+
+    if attacks is None:  # maps file stems to identifiers, once
+      attacks = dict(session.query(File.path, Attack.id).join(Attack))
+      reals = dict(session.query(File.path, RealAccess.id).join(RealAccess))
+
+    if name in existing:
+      if verbose:
+        print("Updating protocol '%s'..." % name)
+      obj = existing[name]
+    else:
       if verbose:
-        print("  -> %5s/%-6s: %d files" % (grp, "attack", counter))
-
-      counter = 0
-      for fname in open(flist[1], 'rt'):
-        s = os.path.splitext(fname.strip())[0]
-        q = session.query(RealAccess).join(File).filter(File.path == s).one()
-        q.protocols.append(obj)
-        counter += 1
+        print("Creating protocol '%s'..." % name)
+      obj = Protocol(name=name)
+      session.add(obj)
+      session.flush()  # assigns the protocol identifier
+
+    attack_ids, real_ids = protocol_members(groups, attacks, reals, verbose)
+
+    for table, column, ids in (
+            (attacks_protocols, 'attack_id', attack_ids),
+            (realaccesses_protocols, 'realaccess_id', real_ids)):
+      c = table.c[column]
+      present = set(k[0] for k in session.query(c).filter(
+          table.c.protocol_id == obj.id))
+      wanted = set(ids)
+      removed = sorted(present - wanted)
+      added = sorted(wanted - present)
+      if removed:
+        session.execute(table.delete().where(and_(
+            table.c.protocol_id == bindparam('pid'), c == bindparam('oid'))),
+            [dict(pid=obj.id, oid=k) for k in removed])
+      if added:
+        session.execute(table.insert(),
+                        [{'protocol_id': obj.id, column: k} for k in added])
       if verbose:
-        print("  -> %5s/%-6s: %d files" % (grp, "real", counter))
+        print("  -> %s: %d added, %d removed" % (table.name, len(added),
+                                                 len(removed)))
 
-    session.add(obj)
+  record_digests(session, current)
+  return True
 
 
 def create_tables(args):
-  """Creates all necessary tables (only to be used at the first time)"""
+  """Creates all necessary tables and indexes (only to be used at the first
+  time, or to add tables and indexes missing from an existing database)"""
 
   from bob.db.base.utils import create_engine_try_nolock
 
   engine = create_engine_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
+  set_compact(engine, getattr(args, 'compact', False))
   Client.metadata.create_all(engine)
   RealAccess.metadata.create_all(engine)
   Attack.metadata.create_all(engine)
   Protocol.metadata.create_all(engine)
+  ListFile.metadata.create_all(engine)
+
+  # indexes are only created together with their tables by create_all()
+  for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+      index.create(engine, checkfirst=True)
 
 # Driver API
 # ==========
@@ -190,6 +469,24 @@ def create(args):
 
   dbfile = args.files[0]
 
+  if args.incremental and not args.recreate and os.path.exists(dbfile):
+    s = session_try_nolock(args.type, dbfile, echo=(args.verbose >= 2))
+    compact = set_compact(s.bind)  # the layout of the database
+    if args.compact is not None and bool(args.compact) != compact:
+      s.close()
+      layouts = ('strings', 'compact')
+      sys.stderr.write("Cannot update '%s' incrementally: it uses the %s layout, not the requested %s one. Re-create it with --recreate to change its layout\n" % (dbfile, layouts[compact], layouts[bool(args.compact)]))
+      return 1
+    args.compact = compact  # also on a full re-creation
+    create_tables(args)  # adds new tables to databases created before
+    updated = update_protocols(s, args.protodir, args.verbose)
+    if updated:
+      s.commit()
+    s.close()
+    if updated:
+      return 0
+    args.recreate = True  # falls back to a full re-creation
+
   if args.recreate:
     if args.verbose and os.path.exists(dbfile):
       print(('unlinking %s...' % dbfile))
@@ -200,12 +497,18 @@ def create(args):
     os.makedirs(os.path.dirname(dbfile))
 
   # the real work...
+  args.compact = bool(args.compact)
   create_tables(args)
   s = session_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
-  add_clients(s, args.protodir, args.verbose)
-  add_real_lists(s, args.protodir, args.verbose)
-  add_attack_lists(s, args.protodir, args.verbose)
+  set_compact(s.bind, args.compact)
+  if args.bulk:
+    bulk_add_lists(s, args.protodir, args.verbose)
+  else:
+    add_clients(s, args.protodir, args.verbose)
+    add_real_lists(s, args.protodir, args.verbose)
+    add_attack_lists(s, args.protodir, args.verbose)
   define_protocols(s, args.protodir, args.verbose)
+  record_digests(s, list_digests(args.protodir))
   s.commit()
   s.close()
 
@@ -219,6 +522,12 @@ def add_command(subparsers):
 
   parser.add_argument('-R', '--recreate', action='store_true', default=False,
                       help="If set, I'll first erase the current database")
+  parser.add_argument('-I', '--incremental', action='store_true', default=False,
+                      help="If set, I'll only update the protocols which lists changed since the database was last created or updated, instead of re-creating it. If lists defining clients or files changed, the database is re-created")
+  parser.add_argument('-b', '--bulk', action='store_true', default=False,
+                      help="If set, I'll insert clients, files, real-accesses and attacks with bulk inserts instead of going through the ORM, which is much faster")
+  parser.add_argument('-C', '--compact', action='store_true', default=None,
+                      help="If set, I'll store enumerated attributes (groups, lights, purposes and attack attributes) as small integer codes instead of strings, which makes the database smaller. Incremental updates keep the layout of the existing database, and fail if this option asks for another one")
   parser.add_argument('-v', '--verbose', action='count', default=0,
                       help="Do SQL operations in a verbose way")
   parser.add_argument('-D', '--protodir', action='store',
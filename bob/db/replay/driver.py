@@ -21,7 +21,7 @@ def reverse(args):
     from bob.db.base.utils import null
     output = null()
 
-  r = db.reverse(args.path)
+  r = db.reverse(args.path, match=args.match)
   for id in r:
     output.write('%d\n' % id)
 
@@ -35,10 +35,12 @@ def reverse_command(subparsers):
   """Adds the specific options for the reverse command"""
 
   from argparse import SUPPRESS
+  from .query import REVERSE_MATCHES
 
   parser = subparsers.add_parser('reverse', help=reverse.__doc__)
 
-  parser.add_argument('path', nargs='+', type=str, help="one or more path stems to look up. If you provide more than one, files which cannot be reversed will be omitted from the output.")
+  parser.add_argument('-m', '--match', dest="match", default='stem', choices=REVERSE_MATCHES, help="how paths are matched against the file stems in the database: complete stems, basenames only or shell-style patterns such as 'devel/attack/hand/*' (defaults to '%(default)s')")
+  parser.add_argument('path', nargs='+', type=str, help="one or more path stems (or basenames, or patterns) to look up. If you provide more than one, files which cannot be reversed will be omitted from the output.")
   parser.add_argument('--self-test', dest="selftest", default=False,
                       action='store_true', help=SUPPRESS)
 
@@ -119,6 +121,18 @@ class Interface(BaseInterface):
     from .checkfiles import add_command as checkfiles_command
     checkfiles_command(subparsers)
 
+    # get the "facecache" action from a submodule
+    from .faces import add_command as facecache_command
+    facecache_command(subparsers)
+
+    # get the "benchmark" action from a submodule
+    from .benchmark import add_command as benchmark_command
+    benchmark_command(subparsers)
+
+    # get the "stats" action from a submodule
+    from .stats import add_command as stats_command
+    stats_command(subparsers)
+
     # adds the "reverse" command
     reverse_command(subparsers)
 
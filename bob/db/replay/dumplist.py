@@ -18,13 +18,18 @@ def dumplist(args):
   from .query import Database
   db = Database()
 
-  r = db.objects(
+  # files are written as they are read, in batches, from the database
+  r = db.iter_objects(
       protocol=args.protocol,
       support=args.support,
       groups=args.group,
       cls=args.cls,
       light=args.light,
       clients=args.client,
+      device=args.device,
+      sample_type=args.sample_type,
+      sample_device=args.sample_device,
+      batch_size=args.batch_size,
   )
 
   output = sys.stdout
@@ -61,9 +66,13 @@ def add_command(subparsers):
   parser.add_argument('-c', '--class', dest="cls", default='', help="if given, limits the dump to a particular subset of the data that corresponds to the given class (defaults to '%(default)s')", choices=('real', 'attack', 'enroll'))
   parser.add_argument('-g', '--group', dest="group", default='', help="if given, this value will limit the output files to those belonging to a particular protocolar group. (defaults to '%(default)s')", choices=db.groups())
   parser.add_argument('-s', '--support', dest="support", default='', help="if given, this value will limit the output files to those using this type of attack support. (defaults to '%(default)s')", choices=db.attack_supports())
+  parser.add_argument('-D', '--device', dest="device", default='', help="if given, this value will limit the output files to those using this type of attack device. (defaults to '%(default)s')", choices=db.attack_devices())
+  parser.add_argument('-t', '--sample-type', dest="sample_type", default='', help="if given, this value will limit the output files to those which attacks were made from this type of sample. (defaults to '%(default)s')", choices=db.attack_sample_types())
+  parser.add_argument('-S', '--sample-device', dest="sample_device", default='', help="if given, this value will limit the output files to those which attack samples were taken with this device. (defaults to '%(default)s')", choices=db.attack_sampling_devices())
   parser.add_argument('-x', '--protocol', dest="protocol", default='', help="if given, this value will limit the output files to those for a given protocol. (defaults to '%(default)s')", choices=protocols)
   parser.add_argument('-l', '--light', dest="light", default='', help="if given, this value will limit the output files to those shot under a given lighting. (defaults to '%(default)s')", choices=db.lights())
   parser.add_argument('-C', '--client', dest="client", default=None, type=int, help="if given, limits the dump to a particular client (defaults to '%(default)s')", choices=clients)
+  parser.add_argument('-b', '--batch-size', dest="batch_size", default=1000, type=int, help="number of files read at once from the database (defaults to %(default)s)")
   parser.add_argument('--self-test', dest="selftest", default=False,
                       action='store_true', help=SUPPRESS)
 
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Fast access to the face locations annotated for the videos of the
+Replay-Attack database.
+"""
+
+import os
+import sys
+import time
+import numpy
+
+from .utils import save_atomic
+
+
+def read_face_file(filename):
+  """Reads a text file with face locations
+
+  Returns a :py:class:`numpy.ndarray` of 32-bit integers with shape ``(n,
+  5)``, each row containing the frame number, the top-left X and Y
+  coordinates, the width and the height of the bounding box of the face
+  detected on that frame.
+  """
+
+  return numpy.loadtxt(filename, dtype=numpy.int32, ndmin=2).reshape(-1, 5)
+
+
+def _generation():
+  """Returns a random, positive 31-bit number identifying a build of a
+  :py:class:`FaceLocationStore`"""
+
+  return int(numpy.random.RandomState().randint(1, 2 ** 31))
+
+
+FILL_METHODS = ('ffill', 'linear')
+"""Methods to fill the frames without face detections in :py:func:`align_bbx`"""
+
+
+def align_bbx(bbx, n_frames=None, fill=None, out=None):
+  """Aligns face locations to the frames of a video
+
+  Keyword parameters:
+
+  bbx
+    The face locations of a video, as returned by :py:meth:`.File.bbx`: an
+    array with shape ``(n, 5)``, each row containing the frame number and
+    the bounding box (X, Y, width and height) of the face on that frame.
+    Rows with non-positive width or height are considered missing
+    detections.
+
+  n_frames
+    [optional] The number of frames of the video. If not set, the last frame
+    with a face location is considered the last frame of the video.
+
+  fill
+    [optional] How frames without a face detection are filled. If not set,
+    their bounding boxes are set to zero. With ``'ffill'``, the last detected
+    bounding box is repeated (frames before the first detection take the
+    first detected bounding box). With ``'linear'``, bounding boxes are
+    linearly interpolated between detections (and held constant before the
+    first and after the last detections).
+
+  out
+    [optional] A pre-allocated array of integers with shape ``(n_frames,
+    4)``, where the bounding boxes are written
+
+  Returns a tuple with an array of shape ``(n_frames, 4)`` with the X, Y,
+  width and height of the face bounding box on each frame and a boolean
+  array of shape ``(n_frames,)`` telling on which frames a face was actually
+  detected.
+  """
+
+  if fill is not None and fill not in FILL_METHODS:
+    raise RuntimeError('Invalid fill method "%s". Valid values are %s' %
+                       (fill, FILL_METHODS))
+
+  bbx = numpy.asarray(bbx).reshape(-1, 5)
+  if n_frames is None:
+    n_frames = int(bbx[:, 0].max()) + 1 if len(bbx) else 0
+
+  if out is None:
+    out = numpy.zeros((n_frames, 4), dtype=numpy.int32)
+  elif out.shape != (n_frames, 4):
+    raise RuntimeError("Output array should have shape %s, but has %s" %
+                       ((n_frames, 4), out.shape))
+  else:
+    out[:] = 0
+
+  keep = (bbx[:, 0] >= 0) & (bbx[:, 0] < n_frames) & \
+      (bbx[:, 3] > 0) & (bbx[:, 4] > 0)
+  bbx = bbx[keep]
+
+  detected = numpy.zeros((n_frames,), dtype=bool)
+  detected[bbx[:, 0]] = True
+  out[bbx[:, 0]] = bbx[:, 1:]
+
+  if fill is None or not len(bbx) or detected.all():
+    return out, detected
+
+  frames = numpy.flatnonzero(detected)
+
+  if fill == 'ffill':
+    # index of the last detection for each frame, or of the first detection
+    index = numpy.where(detected, numpy.arange(n_frames), -1)
+    numpy.maximum.accumulate(index, out=index)
+    index[index < 0] = frames[0]
+    out[:] = out[index]
+
+  else:  # linear
+    x = numpy.arange(n_frames)
+    values = out[frames].astype(float)
+    for c in range(4):
+      out[:, c] = numpy.interp(x, frames, values[:, c]).round()
+
+  return out, detected
+
+
+def align_bbx_batch(locations, n_frames, fill=None, out=None,
+                    detected=None):
+  """Aligns the face locations of many videos to their frames
+
+  This is the same as calling :py:func:`align_bbx` for each video, but
+  results are written on a single pre-allocated array, which can be reused
+  between batches.
+
+  Keyword parameters:
+
+  locations
+    A sequence with the face locations of each video (e.g., as returned by
+    :py:meth:`.FaceLocationStore.batch`)
+
+  n_frames
+    The number of frames of all videos. Face locations past the last frame
+    are ignored and videos with less frames are padded with missing
+    detections.
+
+  fill
+    [optional] How frames without a face detection are filled, as for
+    :py:func:`align_bbx`
+
+  out
+    [optional] A pre-allocated array of integers with shape
+    ``(len(locations), n_frames, 4)``, where the bounding boxes are written
+
+  detected
+    [optional] A pre-allocated boolean array with shape ``(len(locations),
+    n_frames)``, where the detection flags are written
+
+  Returns a tuple with the ``out`` and ``detected`` arrays.
+  """
+
+  if out is None:
+    out = numpy.zeros((len(locations), n_frames, 4), dtype=numpy.int32)
+  if detected is None:
+    detected = numpy.zeros((len(locations), n_frames), dtype=bool)
+
+  for i, bbx in enumerate(locations):
+    detected[i] = align_bbx(bbx, n_frames, fill, out[i])[1]
+
+  return out, detected
+
+
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+"""Weights of the red, green and blue channels for gray-scale conversion
+(ITU-R BT.601)"""
+
+
+def crop_faces(frames, boxes, size, gray=False, out=None):
+  """Crops and resizes faces from a batch of frames, with bilinear
+  interpolation
+
+  Keyword parameters:
+
+  frames
+    An array with shape ``(n, 3, height, width)`` containing color frames
+
+  boxes
+    An integer array with shape ``(n, 4)`` containing the X, Y, width and
+    height of the face bounding box on each frame. Bounding boxes may extend
+    beyond the frame borders, in which case border pixels are repeated.
+
+  size
+    The side of the (square) output images
+
+  gray
+    [optional] If set, crops are converted to gray-scale
+
+  out
+    [optional] A pre-allocated array of unsigned 8-bit integers where crops
+    are written, with shape ``(n, 3, size, size)`` or, for gray-scale crops,
+    ``(n, size, size)``
+
+  Returns the ``out`` array.
+  """
+
+  n, _, height, width = frames.shape
+  shape = (n, size, size) if gray else (n, 3, size, size)
+  if out is None:
+    out = numpy.empty(shape, dtype=numpy.uint8)
+  elif out.shape != shape:
+    raise RuntimeError("Output array should have shape %s, but has %s" %
+                       (shape, out.shape))
+  if not n:
+    return out
+
+  boxes = numpy.asarray(boxes, dtype=float)
+  grid = (numpy.arange(size) + 0.5) / size
+
+  def sample_points(start, extent, limit):
+    """Returns the integer neighbours and weights of each sample point"""
+    p = start[:, None] + grid[None, :] * extent[:, None] - 0.5
+    p = numpy.clip(p, 0, limit - 1)
+    p0 = numpy.floor(p).astype(int)
+    p1 = numpy.minimum(p0 + 1, limit - 1)
+    return p0, p1, (p - p0).astype(numpy.float32)
+
+  x0, x1, wx = sample_points(boxes[:, 0], boxes[:, 2], width)
+  y0, y1, wy = sample_points(boxes[:, 1], boxes[:, 3], height)
+
+  # gathers the 4 neighbours of all sample points: shape (n, size, size, 3)
+  b = numpy.arange(n)[:, None, None]
+  wx = wx[:, None, :, None]
+  wy = wy[:, :, None, None]
+  top = frames[b, :, y0[:, :, None], x0[:, None, :]] * (1 - wx) + \
+      frames[b, :, y0[:, :, None], x1[:, None, :]] * wx
+  bottom = frames[b, :, y1[:, :, None], x0[:, None, :]] * (1 - wx) + \
+      frames[b, :, y1[:, :, None], x1[:, None, :]] * wx
+  crops = top * (1 - wy) + bottom * wy
+
+  if gray:
+    crops = crops.dot(numpy.array(GRAY_WEIGHTS, dtype=numpy.float32))
+  else:
+    crops = crops.transpose(0, 3, 1, 2)
+
+  numpy.clip(numpy.round(crops), 0, 255, out=crops)
+  out[:] = crops
+  return out
+
+
+class FaceLocationCache(object):
+  """A cache of face locations in binary (NumPy) format
+
+  The first time the face locations of a file are requested, its text face
+  file is parsed and saved as a ``.npy`` file in the cache directory, under
+  the same relative path as the original file. Later requests memory-map the
+  binary file, which is much faster than parsing the text again. Cached
+  entries are refreshed if the text face file is modified after them.
+
+  Keyword parameters:
+
+  directory
+    The directory where binary face locations are stored
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def filename(self, file):
+    """Returns the path to the cached face locations of a
+    :py:class:`.File`"""
+
+    return os.path.join(self.directory, file.path + '.npy')
+
+  def update(self, file, directory=None):
+    """Creates or refreshes the cached face locations of a :py:class:`.File`
+    from its text face file, which is looked for in ``directory`` (as for
+    :py:meth:`.File.facefile`). Returns the path to the cached file."""
+
+    source = file.facefile(directory)
+    cached = self.filename(file)
+    if not os.path.exists(cached) or \
+            os.path.getmtime(cached) < os.path.getmtime(source):
+      save_atomic(cached, read_face_file(source))
+    return cached
+
+  def load(self, file, directory=None):
+    """Returns the face locations of a :py:class:`.File` as a (read-only)
+    memory-mapped :py:class:`numpy.ndarray` with shape ``(n, 5)``, updating
+    the cache if necessary"""
+
+    return numpy.load(self.update(file, directory), mmap_mode='r')
+
+
+class FaceLocationStore(object):
+  """A consolidated store with the face locations of many files
+
+  The store is a directory containing two NumPy files: ``locations.npy``,
+  with the face locations of all files concatenated in a single contiguous
+  array of 32-bit integers with shape ``(n, 5)``, and ``offsets.npy``, which
+  maps each file identifier to the range of rows holding its locations.
+  The first row of both files is a header with the generation of the store,
+  a random number drawn every time the store is built, so that a reader
+  never pairs the locations of a build with the offsets of another.
+
+  Opening a store memory-maps the locations and reads the (small) offsets
+  table, after which face locations of any file are served as zero-copy
+  slices of the mapped array, without opening other files.
+
+  Keyword parameters:
+
+  directory
+    The directory containing the store, as created by :py:meth:`build`
+
+  retries
+    [optional] How many times the files are read again if they belong to
+    different generations, as happens while the store is being rebuilt
+  """
+
+  def __init__(self, directory, retries=10):
+    self.directory = directory
+
+    for attempt in range(retries + 1):
+      # offsets are written last: read first, they are never newer than the
+      # locations of the same build
+      offsets = numpy.load(os.path.join(directory, 'offsets.npy'))
+      locations = numpy.load(os.path.join(directory, 'locations.npy'),
+                             mmap_mode='r')
+      if len(offsets) and len(locations) and \
+              offsets[0, 1] == locations[0, 0] and \
+              offsets[0, 2] == len(locations) - 1:
+        break
+      time.sleep(0.1)
+    else:
+      raise RuntimeError("The face location store at '%s' is inconsistent: its locations and offsets were written by different builds" % directory)
+
+    self.generation = int(offsets[0, 1])
+    self.locations = locations[1:]
+    self.m_offsets = dict((int(k[0]), (int(k[1]), int(k[2])))
+                          for k in offsets[1:])
+
+  @staticmethod
+  def build(files, directory, store, cache=None):
+    """Creates a store with the face locations of the given files
+
+    Keyword parameters:
+
+    files
+      The :py:class:`.File` objects whose face locations will be stored
+
+    directory
+      The directory where the text face files are looked for (as for
+      :py:meth:`.File.facefile`)
+
+    store
+      The directory where the store will be created. An existing store is
+      replaced.
+
+    cache
+      [optional] A :py:class:`.FaceLocationCache` (or its directory) used to
+      read the face locations, instead of parsing the text files
+
+    Returns the newly created :py:class:`FaceLocationStore`.
+    """
+
+    if cache is not None and not isinstance(cache, FaceLocationCache):
+      cache = FaceLocationCache(cache)
+
+    generation = _generation()
+    offsets = numpy.empty((len(files) + 1, 3), dtype=numpy.int64)
+    locations = [numpy.array([(generation, 0, 0, 0, 0)], dtype=numpy.int32)]
+    start = 0
+    for i, f in enumerate(files, 1):
+      try:
+        if cache is not None:
+          bbx = cache.load(f, directory)
+        else:
+          bbx = read_face_file(f.facefile(directory))
+      except ValueError as e:
+        raise ValueError('Cannot read face locations from "%s": %s' %
+                         (f.facefile(directory), e))
+      offsets[i] = (f.id, start, start + len(bbx))
+      locations.append(bbx)
+      start += len(bbx)
+
+    locations = numpy.concatenate(locations).astype(numpy.int32)
+    offsets[0] = (-1, generation, start)
+
+    # readers check that both files belong to the same generation
+    save_atomic(os.path.join(store, 'locations.npy'), locations)
+    save_atomic(os.path.join(store, 'offsets.npy'), offsets)
+
+    return FaceLocationStore(store)
+
+  def __len__(self):
+    return len(self.m_offsets)
+
+  def __contains__(self, file_id):
+    return file_id in self.m_offsets
+
+  def __getitem__(self, file_id):
+    """Returns the face locations of the file with the given identifier as a
+    (read-only) view with shape ``(n, 5)`` on the store. Raises
+    :py:exc:`KeyError` if the file is not in the store."""
+
+    start, stop = self.m_offsets[file_id]
+    return self.locations[start:stop]
+
+  def bbx(self, file):
+    """Returns the face locations of a :py:class:`.File`"""
+
+    return self[file.id]
+
+  def batch(self, files):
+    """Returns a list with the face locations of each :py:class:`.File` in
+    ``files``, as views on the store"""
+
+    return [self[k.id] for k in files]
+
+# Driver API
+# ==========
+
+
+def facecache(args):
+  """Converts face locations to binary format for fast loading"""
+
+  if not args.cache and not args.store:
+    sys.stderr.write('facecache: at least one of --cache (-o) or --store (-S) must be given\n')
+    return 1
+
+  from .query import Database
+  db = Database()
+
+  r = db.objects(
+      protocol=args.protocol,
+      support=args.support,
+      groups=args.group,
+      cls=args.cls,
+      light=args.light,
+      clients=args.client,
+  )
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  bad = []
+  cache = None
+  if args.cache:
+    cache = FaceLocationCache(args.cache)
+    for f in r:
+      try:
+        cache.update(f, args.directory)
+      except (IOError, OSError, ValueError) as e:  # missing or malformed
+        output.write('Cannot cache face locations of "%s" from "%s": %s\n' %
+                     (f.path, f.facefile(args.directory), e))
+        bad.append(f)
+
+    output.write('%d face location files (out of %d) were cached at "%s"\n' %
+                 (len(r) - len(bad), len(r), args.cache))
+
+  if bad:
+    return 1
+
+  if args.store:
+    try:
+      store = FaceLocationStore.build(r, args.directory, args.store, cache)
+    except (IOError, OSError, ValueError) as e:
+      output.write('Cannot build face location store: %s\n' % (e,))
+      return 1
+    output.write('%d face locations of %d files were stored at "%s"\n' %
+                 (len(store.locations), len(store), args.store))
+
+  return 0
+
+
+def add_command(subparsers):
+  """Add specific subcommands that the action "facecache" can use"""
+
+  from argparse import SUPPRESS
+
+  parser = subparsers.add_parser('facecache', help=facecache.__doc__)
+
+  from .query import Database
+
+  db = Database()
+
+  if not db.is_valid():
+    protocols = ('waiting', 'for', 'database', 'creation')
+    clients = tuple()
+  else:
+    protocols = [k.name for k in db.protocols()]
+    clients = [k.id for k in db.clients()]
+
+  parser.add_argument('-d', '--directory', dest="directory", default='', help="the directory containing the 'face-locations' directory of the database (defaults to '%(default)s')")
+  parser.add_argument('-o', '--cache', dest="cache", default=None, help="if given, the directory where binary face locations of each file are cached")
+  parser.add_argument('-S', '--store', dest="store", default=None, help="if given, the directory where a consolidated store with the face locations of all selected files is created")
+  parser.add_argument('-c', '--class', dest="cls", default='', help="if given, limits the conversion to a particular subset of the data that corresponds to the given class (defaults to '%(default)s')", choices=('real', 'attack', 'enroll'))
+  parser.add_argument('-g', '--group', dest="group", default='', help="if given, this value will limit the conversion to those files belonging to a particular protocolar group. (defaults to '%(default)s')", choices=db.groups())
+  parser.add_argument('-s', '--support', dest="support", default='', help="if given, this value will limit the conversion to those files using this type of attack support. (defaults to '%(default)s')", choices=db.attack_supports())
+  parser.add_argument('-x', '--protocol', dest="protocol", default='', help="if given, this value will limit the conversion to those files for a given protocol. (defaults to '%(default)s')", choices=protocols)
+  parser.add_argument('-l', '--light', dest="light", default='', help="if given, this value will limit the conversion to those files shot under a given lighting. (defaults to '%(default)s')", choices=db.lights())
+  parser.add_argument('-C', '--client', dest="client", default=None, type=int, help="if given, limits the conversion to a particular client (defaults to '%(default)s')", choices=clients)
+  parser.add_argument('--self-test', dest="selftest", default=False,
+                      action='store_true', help=SUPPRESS)
+
+  parser.set_defaults(func=facecache)  # action
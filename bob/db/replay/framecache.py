@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A disk-backed cache of decoded video frames, shared between processes.
+"""
+
+import os
+import errno
+import hashlib
+import numpy
+
+from .utils import save_atomic
+
+try:
+  import fcntl
+except ImportError:  # not a POSIX system
+  fcntl = None
+
+
+def _normalize(value):
+  """Returns a canonical, hashable representation of a decoding option"""
+
+  if isinstance(value, slice):
+    return ('slice', value.start, value.stop, value.step)
+  if isinstance(value, (list, tuple, numpy.ndarray)):
+    return tuple(numpy.asarray(value).reshape(-1).tolist())
+  return value
+
+
+def _stat(filename):
+  """Returns the modification time and size of a file, or ``None`` if it
+  does not exist"""
+
+  try:
+    stat = os.stat(filename)
+  except OSError:
+    return None
+  return (stat.st_mtime, stat.st_size)
+
+
+class FrameCache(object):
+  """A cache of decoded (possibly sampled or cropped) video frames on disk
+
+  Entries are keyed by the identifier and path of a :py:class:`.File`
+  together with the options used to decode it (e.g., the resolved file name
+  and the frame selection) and the modification time and size of the source
+  files, so that a re-encoded or replaced video is decoded again. Entries
+  are stored as NumPy files, which are memory-mapped when read, and are
+  written atomically, so that multiple processes on the same machine can
+  share a cache directory.
+
+  Once the total size of the cache exceeds its byte budget, the least
+  recently used entries (by modification time, which is refreshed at every
+  hit) are removed. Eviction is serialized between processes with a lock
+  file.
+
+  Caching is opt-in: pass the cache as the ``frame_cache`` argument of
+  :py:meth:`.File.load`, :py:meth:`.File.frames` or
+  :py:meth:`.File.load_faces` (or of :py:meth:`.Database.load_batch` and
+  :py:meth:`.Database.prefetch`). Other callers keep getting freshly decoded
+  arrays.
+
+  Keyword parameters:
+
+  directory
+    The directory where cached frames are stored. It is created if it does
+    not exist.
+
+  max_bytes
+    [optional] The maximum size, in bytes, of all entries in the cache. If
+    not set, the cache is never pruned.
+  """
+
+  def __init__(self, directory, max_bytes=None):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:  # created concurrently
+        if not os.path.isdir(directory):
+          raise
+
+  def key(self, file, **options):
+    """Returns the key identifying the decoded data of a :py:class:`.File`
+    for the given decoding options. Options set to ``None`` are ignored.
+
+    Options named ``filename`` or ending with ``_file`` are the paths of the
+    files the data are decoded from: the modification time and size of
+    those which exist are part of the key."""
+
+    sources = sorted((k, _stat(v)) for k, v in options.items()
+                     if v is not None and (k == 'filename' or
+                                           k.endswith('_file')))
+    options = sorted((k, _normalize(v)) for k, v in options.items()
+                     if v is not None)
+    description = repr((file.id, str(file.path), options, sources))
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+  def filename(self, key):
+    """Returns the path of the entry with the given key"""
+
+    return os.path.join(self.directory, key + '.npy')
+
+  def get(self, file, **options):
+    """Returns the cached data of a :py:class:`.File` for the given decoding
+    options as a read-only memory-mapped array, or ``None`` if it is not in
+    the cache"""
+
+    filename = self.filename(self.key(file, **options))
+    try:
+      os.utime(filename, None)  # marks as recently used
+      return numpy.load(filename, mmap_mode='r')
+    except (IOError, OSError) as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return None  # not cached, or evicted concurrently
+
+  def put(self, file, data, **options):
+    """Stores the data of a :py:class:`.File` decoded with the given options
+    and evicts old entries if the cache exceeds its budget"""
+
+    save_atomic(self.filename(self.key(file, **options)), data)
+    self.evict()
+
+  def entries(self):
+    """Returns a list with the path, size and last access time of every entry,
+    from the least to the most recently used"""
+
+    retval = []
+    for k in os.listdir(self.directory):
+      if not k.endswith('.npy'):
+        continue
+      filename = os.path.join(self.directory, k)
+      try:
+        stat = os.stat(filename)
+      except OSError:  # evicted concurrently
+        continue
+      retval.append((filename, stat.st_size, stat.st_mtime))
+    return sorted(retval, key=lambda k: k[2])
+
+  def size(self):
+    """Returns the total size, in bytes, of all entries in the cache"""
+
+    return sum(k[1] for k in self.entries())
+
+  def _evict(self, max_bytes):
+    """Removes least recently used entries until the cache fits the budget"""
+
+    entries = self.entries()
+    total = sum(k[1] for k in entries)
+    for filename, size, _ in entries:
+      if total <= max_bytes:
+        break
+      try:
+        os.unlink(filename)
+      except OSError:  # evicted concurrently
+        pass
+      total -= size
+
+  def evict(self, max_bytes=None):
+    """Removes the least recently used entries until the total size of the
+    cache is not larger than ``max_bytes`` (by default, the budget of the
+    cache)"""
+
+    if max_bytes is None:
+      max_bytes = self.max_bytes
+    if max_bytes is None:
+      return
+
+    if fcntl is None:
+      return self._evict(max_bytes)
+
+    with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        self._evict(max_bytes)
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def clear(self):
+    """Removes all entries from the cache"""
+
+    self.evict(0)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""In-memory indexes over the metadata of the Replay-Attack database, which
+answer :py:meth:`.Database.objects` and :py:meth:`.Database.reverse` queries
+without going back to SQLite.
+"""
+
+import os
+import bisect
+import fnmatch
+
+from .models import *
+
+
+class MetadataIndex(object):
+  """In-memory metadata index for all files in the database
+
+  All file rows, together with their client set, illumination, attack
+  attributes and protocol membership are loaded once, with a handful of bulk
+  queries, at construction time. Each attribute value is then mapped to a
+  posting list (the set of file identifiers having that value), so that
+  answering a query amounts to a few set intersections.
+
+  Results are sorted in the same way as the SQL queries in
+  :py:meth:`.Database.objects`: by class (enroll, real, attack), then by
+  client identifier and, finally, by file identifier.
+
+  Keyword parameters:
+
+  session
+    The SQLAlchemy session connected to the database to be indexed. The
+    :py:class:`.File` objects returned by :py:meth:`objects` are bound to this
+    session.
+  """
+
+  def __init__(self, session):
+
+    files = session.query(File).order_by(File.id).all()
+    self.m_files = dict((k.id, k) for k in files)
+
+    # sorting key for results: client identifier, then file identifier
+    order = sorted((k.client_id, k.id) for k in files)
+    self.m_rank = dict((v[1], i) for i, v in enumerate(order))
+
+    self.m_group = {}
+    self.m_client = {}
+    for file_id, client_id, group in session.query(File.id, Client.id,
+                                                   Client.set).join(Client):
+      self.m_group.setdefault(group, set()).add(file_id)
+      self.m_client.setdefault(client_id, set()).add(file_id)
+
+    self.m_light = {}
+    for k in files:
+      self.m_light.setdefault(k.light, set()).add(k.id)
+
+    self.m_enroll = set(k[0] for k in session.query(RealAccess.file_id).filter(
+        RealAccess.purpose == 'enroll'))
+
+    self.m_support = {}
+    self.m_device = {}
+    self.m_sample_type = {}
+    self.m_sample_device = {}
+    for file_id, support, device, sample_type, sample_device in \
+            session.query(Attack.file_id, Attack.attack_support,
+                          Attack.attack_device, Attack.sample_type,
+                          Attack.sample_device):
+      self.m_support.setdefault(support, set()).add(file_id)
+      self.m_device.setdefault(device, set()).add(file_id)
+      self.m_sample_type.setdefault(sample_type, set()).add(file_id)
+      self.m_sample_device.setdefault(sample_device, set()).add(file_id)
+
+    self.m_protocols = frozenset(k.name for k in session.query(Protocol))
+    self.m_real = dict((k, set()) for k in self.m_protocols)
+    self.m_attack = dict((k, set()) for k in self.m_protocols)
+
+    q = session.query(RealAccess.file_id, Protocol.name).select_from(
+        RealAccess).join(RealAccess.protocols)
+    for file_id, name in q:
+      self.m_real[name].add(file_id)
+
+    q = session.query(Attack.file_id, Protocol.name).select_from(
+        Attack).join(Attack.protocols)
+    for file_id, name in q:
+      self.m_attack[name].add(file_id)
+
+  def __len__(self):
+    return len(self.m_files)
+
+  def _union(self, postings, keys):
+    """Returns the union of the posting lists of the given keys"""
+
+    retval = set()
+    for k in keys:
+      retval.update(postings.get(k, ()))
+    return retval
+
+  def _restrict(self, ids, postings, keys):
+    """Intersects ``ids`` with the posting lists of ``keys``, if given"""
+
+    if keys:
+      ids &= self._union(postings, keys)
+    return ids
+
+  def file_ids(self, support, protocol, groups, cls, light, clients,
+               device=None, sample_type=None, sample_device=None):
+    """Returns the ordered list of file identifiers matching the query
+
+    The parameters are those of :py:meth:`.Database.objects`, after
+    validation: each one is either ``None`` (no filtering) or an iterable of
+    valid values.
+    """
+
+    retval = []
+
+    for c in ('enroll', 'real', 'attack'):
+      if c not in cls:
+        continue
+
+      if c == 'enroll':
+        ids = set(self.m_enroll)
+      elif c == 'real':
+        ids = self._union(self.m_real, protocol)
+      else:
+        ids = self._union(self.m_attack, protocol)
+        ids = self._restrict(ids, self.m_support, support)
+        ids = self._restrict(ids, self.m_device, device)
+        ids = self._restrict(ids, self.m_sample_type, sample_type)
+        ids = self._restrict(ids, self.m_sample_device, sample_device)
+
+      ids = self._restrict(ids, self.m_group, groups)
+      ids = self._restrict(ids, self.m_client, clients)
+      ids = self._restrict(ids, self.m_light, light)
+
+      retval += sorted(ids, key=self.m_rank.__getitem__)
+
+    return retval
+
+  def objects(self, support, protocol, groups, cls, light, clients,
+              device=None, sample_type=None, sample_device=None):
+    """Returns the ordered list of :py:class:`.File` objects matching the
+    query. Parameters are the same as for :py:meth:`file_ids`."""
+
+    return [self.m_files[k] for k in
+            self.file_ids(support, protocol, groups, cls, light, clients,
+                          device, sample_type, sample_device)]
+
+
+class PathIndex(object):
+  """In-memory index over the path stems of all files in the database
+
+  It answers reverse lookups (from path stems to file identifiers) by exact
+  stem, by basename, by prefix or by shell-style pattern.
+
+  Keyword parameters:
+
+  session
+    The SQLAlchemy session connected to the database to be indexed
+  """
+
+  def __init__(self, session):
+
+    self.m_stems = dict((path, file_id) for file_id, path in
+                        session.query(File.id, File.path))
+
+    self.m_basenames = {}
+    for path, file_id in self.m_stems.items():
+      self.m_basenames.setdefault(os.path.basename(path), []).append(file_id)
+    for v in self.m_basenames.values():
+      v.sort()
+
+    # sorted stems allow for prefix searches through bisection
+    self.m_sorted = sorted(self.m_stems)
+
+  def __len__(self):
+    return len(self.m_stems)
+
+  def stem(self, path):
+    """Returns a list with the identifier of the file with the given stem,
+    or an empty list if no such file exists"""
+
+    if path in self.m_stems:
+      return [self.m_stems[path]]
+    return []
+
+  def basename(self, name):
+    """Returns the (sorted) identifiers of all files with the given basename"""
+
+    return list(self.m_basenames.get(name, []))
+
+  def prefix(self, prefix):
+    """Returns the identifiers of all files which stem starts with the given
+    prefix, sorted by stem"""
+
+    start = bisect.bisect_left(self.m_sorted, prefix)
+    retval = []
+    for path in self.m_sorted[start:]:
+      if not path.startswith(prefix):
+        break
+      retval.append(self.m_stems[path])
+    return retval
+
+  def glob(self, pattern):
+    """Returns the identifiers of all files which stem matches the given
+    shell-style pattern (see :py:mod:`fnmatch`), sorted by stem
+
+    Patterns ending in ``/``, or whose only wildcard is a trailing ``*``, are
+    resolved as prefix searches, without scanning all stems.
+    """
+
+    if pattern.endswith('/') and not _has_magic(pattern):
+      return self.prefix(pattern)
+    if pattern.endswith('*') and not _has_magic(pattern[:-1]):
+      return self.prefix(pattern[:-1])
+    return [self.m_stems[k] for k in fnmatch.filter(self.m_sorted, pattern)]
+
+
+def _has_magic(pattern):
+  """Tells if a pattern contains any shell-style wildcards"""
+
+  return any(k in pattern for k in '*?[')
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Parallel loading of the data of many files of the Replay-Attack database.
+"""
+
+import os
+import time
+import queue
+import threading
+import collections
+import concurrent.futures
+import traceback
+import numpy
+
+from .models import File
+
+PREFETCH_BACKENDS = ('thread', 'process')
+"""Kinds of workers that may decode data ahead of a :py:class:`Prefetcher`"""
+
+
+class LoadResult(collections.namedtuple('LoadResult', 'file data error')):
+  """The outcome of loading the data of one :py:class:`.File` in a batch
+
+  ``file`` is the :py:class:`.File` that was loaded. If loading succeeded,
+  ``data`` holds what :py:meth:`.File.load` returned and ``error`` is
+  ``None``. Otherwise, ``data`` is ``None`` and ``error`` is the exception
+  that was raised, with the formatted traceback of the worker in its
+  ``traceback`` attribute.
+  """
+
+  __slots__ = ()
+
+  @property
+  def ok(self):
+    """Tells if the data of the file could be loaded"""
+    return self.error is None
+
+
+class _FileRef(object):
+  """A picklable stand-in for a :py:class:`.File`, holding only what
+  :py:meth:`.File.load` requires, which is sent to worker processes instead
+  of the (session-bound) file object"""
+
+  __slots__ = ('id', 'path')
+
+  def __init__(self, id, path):
+    self.id = id
+    self.path = str(path)
+
+  make_path = File.make_path
+  load = File.load
+
+
+def _load(task):
+  """Loads the data of a single file, returning it together with the
+  exception raised while loading, if any"""
+
+  file, options = task
+  try:
+    return file.load(**options), None
+  except Exception as e:
+    e.traceback = traceback.format_exc()
+    return None, e
+
+
+def load_batch(files, directory=None, extension=None, frames=None,
+               nframes=None, workers=None, ordered=True, max_pending=None,
+               frame_cache=None):
+  """Loads the data of many files in a pool of worker processes
+
+  Every file is loaded with :py:meth:`.File.load`, in a separate process, so
+  that videos are decoded in parallel. A failure to load a file does not stop
+  the batch: it is reported in the corresponding :py:class:`LoadResult`.
+
+  Keyword parameters:
+
+  files
+    An iterable of :py:class:`.File` objects to load
+
+  directory, extension, frames, nframes, frame_cache
+    Passed to :py:meth:`.File.load` for every file
+
+  workers
+    [optional] The number of worker processes. If not set, one process is
+    started per CPU. With ``0`` or ``1``, files are loaded in the calling
+    process, one after the other.
+
+  ordered
+    [optional] If set (the default), results are yielded in the same order as
+    ``files``. Otherwise, they are yielded as soon as they are available.
+
+  max_pending
+    [optional] The maximum number of files being loaded, or loaded and not yet
+    yielded, at any time, which bounds the memory used by the batch. Defaults
+    to twice the number of workers.
+
+  Yields one :py:class:`LoadResult` per file.
+  """
+
+  options = dict(directory=directory, extension=extension, frames=frames,
+                 nframes=nframes, frame_cache=frame_cache)
+
+  if workers is None:
+    workers = os.cpu_count() or 1
+
+  if workers <= 1:
+    for f in files:
+      data, error = _load((f, options))
+      yield LoadResult(f, data, error)
+    return
+
+  if max_pending is None:
+    max_pending = 2 * workers
+
+  executor = concurrent.futures.ProcessPoolExecutor(workers)
+
+  for k in _pipeline(executor, files, options, max_pending, ordered):
+    yield k
+
+
+def _pipeline(executor, files, options, max_pending, ordered):
+  """Loads files with an executor, keeping at most ``max_pending`` of them
+  submitted and not yet yielded, and yields a :py:class:`LoadResult` for
+  each one. The executor is shut down once all files are loaded, or if the
+  generator is closed."""
+
+  files = iter(files)
+  pending = collections.OrderedDict()  # future -> file, in submission order
+
+  def submit():
+    for f in files:
+      task = (_FileRef(f.id, f.path), options)
+      pending[executor.submit(_load, task)] = f
+      return True
+    return False
+
+  try:
+    if max_pending < 1:
+      raise RuntimeError("The number of pending files must be positive, but got %d" % max_pending)
+
+    while len(pending) < max_pending and submit():
+      pass
+
+    while pending:
+      if ordered:
+        done = [next(iter(pending))]
+      else:
+        done = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+
+      for future in done:
+        f = pending.pop(future)
+        try:
+          data, error = future.result()
+        except Exception as e:  # e.g. the worker died or data is unpicklable
+          data, error = None, e
+        submit()
+        yield LoadResult(f, data, error)
+
+  finally:
+    for future in pending:
+      future.cancel()
+    executor.shutdown(wait=True)
+
+
+class _Failure(object):
+  """Carries an exception raised in the feeder of a :py:class:`Prefetcher`
+  to the consumer"""
+
+  def __init__(self, error):
+    self.error = error
+
+
+_END = object()  # marks the end of an epoch in the queue of a Prefetcher
+
+
+class Prefetcher(object):
+  """Iterates over the data of a list of files, decoding them ahead of the
+  consumer in the background
+
+  Files are loaded with :py:meth:`.File.load` by a pool of threads or
+  processes and their data are put on a bounded queue, from which the
+  iterator takes them. Decoding thus overlaps with the processing of
+  previous items, while at most ``depth`` loaded items (plus one per
+  worker being loaded) are held in memory.
+
+  Every iteration over the prefetcher is an epoch. If ``shuffle`` is set,
+  files are visited in a different order at every epoch; with a ``seed``,
+  the order of each epoch is reproducible. Items are yielded in this order,
+  whatever the number of workers.
+
+  Keyword parameters:
+
+  files
+    The list of :py:class:`.File` objects to iterate over
+
+  directory, extension, frames, nframes, frame_cache
+    Passed to :py:meth:`.File.load` for every file
+
+  chunk
+    [optional] If not set, yields ``(file, data)`` tuples, one per file.
+    Otherwise, the data of every file is split in chunks of at most this
+    number of frames, each one being a separate item of the queue, and
+    yields ``(file, start, frames)`` tuples, where ``start`` is the index of
+    the first frame of the chunk in the loaded data.
+
+  depth
+    [optional] The maximum number of items waiting in the queue
+
+  workers
+    [optional] The number of threads or processes loading files
+
+  backend
+    [optional] Either ``'thread'`` (the default) or ``'process'``. Processes
+    sidestep the global interpreter lock, at the expense of copying the
+    decoded data back to the consumer.
+
+  shuffle
+    [optional] If set, shuffles the files at every epoch
+
+  seed
+    [optional] The seed of the per-epoch shuffling
+
+  skip_errors
+    [optional] If set, files that cannot be loaded are skipped (and counted
+    in the statistics). Otherwise (the default), the first error is raised
+    by the iterator.
+  """
+
+  def __init__(self, files, directory=None, extension=None, frames=None,
+               nframes=None, chunk=None, depth=4, workers=1,
+               backend='thread', shuffle=False, seed=None, skip_errors=False,
+               frame_cache=None):
+
+    if backend not in PREFETCH_BACKENDS:
+      raise RuntimeError('Invalid prefetch backend "%s". Valid values are %s' %
+                         (backend, PREFETCH_BACKENDS))
+    if depth < 1:
+      raise RuntimeError("The queue depth must be positive, but got %d" % depth)
+    if workers < 1:
+      raise RuntimeError("The number of workers must be positive, but got %d" % workers)
+
+    self.files = list(files)
+    self.options = dict(directory=directory, extension=extension,
+                        frames=frames, nframes=nframes,
+                        frame_cache=frame_cache)
+    self.chunk = chunk
+    self.depth = depth
+    self.workers = workers
+    self.backend = backend
+    self.shuffle = shuffle
+    self.seed = seed
+    self.skip_errors = skip_errors
+    self.epoch = 0
+    self.m_stats = None
+
+  def __len__(self):
+    return len(self.files)
+
+  def order(self, epoch):
+    """Returns the list of files in the order they are visited at the given
+    epoch"""
+
+    if not self.shuffle:
+      return list(self.files)
+    if self.seed is None:
+      rng = numpy.random.RandomState()
+    else:
+      rng = numpy.random.RandomState([self.seed, epoch])
+    return [self.files[k] for k in rng.permutation(len(self.files))]
+
+  def set_epoch(self, epoch):
+    """Sets the epoch (and, therefore, the order of files) of the next
+    iteration. Epochs otherwise increase by one at every iteration."""
+
+    self.epoch = epoch
+
+  def statistics(self):
+    """Returns statistics about the last (or current) epoch, to tune the
+    queue depth and the number of workers
+
+    The returned dictionary has the following keys:
+
+    epoch
+      The epoch the statistics refer to
+
+    items
+      The number of items yielded
+
+    skipped
+      The number of files that could not be loaded and were skipped
+
+    wait_time
+      The total time (in seconds) the consumer waited for items
+
+    max_wait
+      The longest time (in seconds) the consumer waited for a single item
+
+    stalls
+      The number of times the consumer found the queue empty
+
+    mean_depth
+      The average number of items in the queue when the consumer asked for
+      the next one. Values close to ``depth`` mean that loading is faster
+      than the consumer; values close to zero, that the consumer waits.
+    """
+
+    if self.m_stats is None:
+      return None
+    retval = dict(self.m_stats)
+    depth = retval.pop('depth')
+    retval['mean_depth'] = float(depth) / retval['items'] if retval['items'] \
+        else 0.
+    return retval
+
+  def _executor(self):
+    """Returns a new pool of workers for the configured backend"""
+
+    if self.backend == 'thread':
+      return concurrent.futures.ThreadPoolExecutor(self.workers)
+    return concurrent.futures.ProcessPoolExecutor(self.workers)
+
+  def _feed(self, files, output, stop):
+    """Loads files and puts their data on the ``output`` queue, until all
+    files are loaded or ``stop`` is set"""
+
+    def put(item):
+      while not stop.is_set():
+        try:
+          output.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    results = _pipeline(self._executor(), files, self.options, self.workers,
+                        True)
+    try:
+      for k in results:
+        if k.error is not None:
+          if self.skip_errors:
+            self.m_stats['skipped'] += 1
+            continue
+          put(_Failure(k.error))
+          return
+
+        if self.chunk:
+          for start in range(0, len(k.data), self.chunk):
+            if not put((k.file, start, k.data[start:start + self.chunk])):
+              return
+        elif not put((k.file, k.data)):
+          return
+
+    except Exception as e:
+      put(_Failure(e))
+      return
+
+    finally:
+      results.close()
+
+    put(_END)
+
+  def __iter__(self):
+
+    files = self.order(self.epoch)
+    self.m_stats = dict(epoch=self.epoch, items=0, skipped=0, wait_time=0.,
+                        max_wait=0., stalls=0, depth=0)
+    self.epoch += 1
+
+    output = queue.Queue(self.depth)
+    stop = threading.Event()
+    feeder = threading.Thread(target=self._feed, args=(files, output, stop))
+    feeder.daemon = True
+    feeder.start()
+
+    stats = self.m_stats
+    try:
+      while True:
+        depth = output.qsize()
+        start = time.time()
+        item = output.get()
+        wait = time.time() - start
+
+        if item is _END:
+          return
+        if isinstance(item, _Failure):
+          raise item.error
+
+        stats['items'] += 1
+        stats['depth'] += depth
+        stats['stalls'] += depth == 0
+        stats['wait_time'] += wait
+        stats['max_wait'] = max(stats['max_wait'], wait)
+        yield item
+
+    finally:
+      stop.set()
+      feeder.join()
@@ -7,7 +7,10 @@
 """
 
 import os
-from sqlalchemy import Table, Column, Integer, String, ForeignKey
+import weakref
+from sqlalchemy import Table, Column, Integer, SmallInteger, String, ForeignKey, Index
+from sqlalchemy import text
+from sqlalchemy.types import TypeDecorator
 from bob.db.base.sqlalchemy_migration import Enum, relationship
 import bob.db.base
 import bob.db.base.utils
@@ -16,11 +19,103 @@ from sqlalchemy.ext.declarative import declarative_base
 import numpy
 import bob
 import bob.io.video
+from .video import iter_frames, iter_video, iter_array, load_frames, \
+    frame_indices
+from .framecache import FrameCache
 
 
 Base = declarative_base()
 
 
+_layouts = weakref.WeakKeyDictionary()
+"""Maps the dialect of every engine (each engine has its own) to the layout
+of enumerations set with :py:func:`set_compact`"""
+
+
+def is_compact(dialect):
+  """Tells if enumerations are stored as integer codes through the given
+  SQLAlchemy dialect (see :py:func:`set_compact`)
+
+  Raises a RuntimeError if the layout was not set for the engine of the
+  dialect, which would otherwise read or write a compact database as if it
+  held strings.
+  """
+
+  try:
+    return _layouts[dialect]
+  except KeyError:
+    raise RuntimeError("The layout of enumerations is not set for this engine: call set_compact() before using it with the tables of the Replay-Attack database")
+
+
+def set_compact(bind, compact=None):
+  """Sets the layout of the enumerations in the database an engine is
+  connected to
+
+  This must be called before the engine is used with the tables of this
+  module: the layout cannot be changed afterwards.
+
+  Keyword parameters:
+
+  bind
+    The SQLAlchemy engine (e.g., the ``bind`` of a session)
+
+  compact
+    If set, enumerations are stored as small integers, their index in the
+    corresponding ``*_choices`` tuple; otherwise, as strings. If ``None``
+    (the default), the layout is detected from the existing ``client``
+    table, defaulting to strings if there is none.
+
+  Returns the layout that was set (``True`` if compact). Raises a
+  RuntimeError if another layout was already set for the engine.
+  """
+
+  if compact is None:
+    with bind.connect() as connection:
+      columns = connection.execute(text('PRAGMA table_info(client)')).fetchall()
+    types = dict((k[1], k[2].upper()) for k in columns)
+    compact = 'INT' in types.get('set', '')
+
+  compact = bool(compact)
+  if _layouts.get(bind.dialect, compact) != compact:
+    raise RuntimeError("The layout of enumerations of this engine is already set to %s and cannot be changed" % ('compact' if _layouts[bind.dialect] else 'strings'))
+  _layouts[bind.dialect] = compact
+  return compact
+
+
+class CodedEnum(TypeDecorator):
+  """An enumeration, stored either as a string or, in compact databases (see
+  :py:func:`set_compact`), as the index of the value in its list of choices
+
+  Values are always strings on the Python side, whatever the layout.
+  """
+
+  impl = String
+  cache_ok = True
+
+  def __init__(self, *choices):
+    self.choices = tuple(choices)
+    self.codes = dict((k, i) for i, k in enumerate(choices))
+    super(CodedEnum, self).__init__(max(len(k) for k in choices))
+
+  def load_dialect_impl(self, dialect):
+    if is_compact(dialect):
+      return dialect.type_descriptor(SmallInteger())
+    return dialect.type_descriptor(Enum(*self.choices))
+
+  def process_bind_param(self, value, dialect):
+    if value is None or not is_compact(dialect):
+      return value
+    if value not in self.codes:
+      raise RuntimeError('Invalid value "%s". Valid values are %s' %
+                         (value, self.choices))
+    return self.codes[value]
+
+  def process_result_value(self, value, dialect):
+    if isinstance(value, int):
+      return self.choices[value]
+    return value
+
+
 class Client(Base):
   """Database clients, marked by an integer identifier and the set they belong
   to"""
@@ -33,7 +128,7 @@ class Client(Base):
   id = Column(Integer, primary_key=True)
   """Key identifier for clients"""
 
-  set = Column(Enum(*set_choices))
+  set = Column(CodedEnum(*set_choices), index=True)
   """Set to which this client belongs to"""
 
   def __init__(self, id, set):
@@ -55,13 +150,13 @@ class File(Base, bob.db.base.File):
   id = Column(Integer, primary_key=True)
   """Key identifier for files"""
 
-  client_id = Column(Integer, ForeignKey('client.id'))  # for SQL
+  client_id = Column(Integer, ForeignKey('client.id'), index=True)  # for SQL
   """The client identifier to which this file is bound to"""
 
   path = Column(String(100), unique=True)
   """The (unique) path to this file inside the database"""
 
-  light = Column(Enum(*light_choices))
+  light = Column(CodedEnum(*light_choices), index=True)
   """The illumination condition in which the data for this file was taken"""
 
   # for Python
@@ -106,7 +201,7 @@ class File(Base, bob.db.base.File):
     directory = os.path.join(directory, 'face-locations')
     return self.make_path(directory, '.face')
 
-  def bbx(self, directory=None):
+  def bbx(self, directory=None, cache=None, store=None):
     """Reads the file containing the face locations for the frames in the
     current video
 
@@ -116,6 +211,18 @@ class File(Base, bob.db.base.File):
       A directory name that will be prepended to the final filepaths where the
       face bounding boxes are located, if not on the current directory.
 
+    cache
+      If set, a directory where face locations are cached in binary format
+      (see :py:class:`.FaceLocationCache`). The text face file is parsed only
+      the first time (or if it was modified since), after which the
+      locations are memory-mapped from the cache. Returned locations are then
+      32-bit integers in a read-only array with shape ``(n, 5)``.
+
+    store
+      If set, a :py:class:`.FaceLocationStore` (or the directory containing
+      it) from which face locations are served as a read-only view, with the
+      same format as for ``cache``. Text face files are not read at all.
+
     Returns:
       A :py:class:`numpy.ndarray` containing information about the located
       faces in the videos. Each row of the :py:class:`numpy.ndarray`
@@ -131,8 +238,45 @@ class File(Base, bob.db.base.File):
       Note that **not** all the frames may contain detected faces.
     """
 
+    if store is not None:
+      from .faces import FaceLocationStore
+      if not isinstance(store, FaceLocationStore):
+        store = FaceLocationStore(store)
+      return store.bbx(self)
+
+    if cache is not None:
+      from .faces import FaceLocationCache
+      return FaceLocationCache(cache).load(self, directory)
+
     return numpy.loadtxt(self.facefile(directory), dtype=int)
 
+  def dense_bbx(self, directory=None, n_frames=None, fill=None, cache=None,
+                store=None):
+    """Returns the face bounding boxes aligned to the frames of the video
+
+    Keyword parameters:
+
+    directory, cache, store
+      Where to read face locations from, as for :py:meth:`bbx`
+
+    n_frames
+      [optional] The number of frames in the video. If not set, the last
+      frame with a face location is considered the last frame of the video.
+
+    fill
+      [optional] How frames without a face detection are filled: ``None``
+      (zeros), ``'ffill'`` (repeats the last detection) or ``'linear'``
+      (interpolates between detections). See :py:func:`.align_bbx`.
+
+    Returns a tuple with an integer array of shape ``(n_frames, 4)`` with the
+    X, Y, width and height of the face bounding box on each frame and a
+    boolean array of shape ``(n_frames,)`` telling on which frames a face was
+    actually detected.
+    """
+
+    from .faces import align_bbx
+    return align_bbx(self.bbx(directory, cache, store), n_frames, fill)
+
   def is_real(self):
     """Returns True if this file belongs to a real access, False otherwise"""
 
@@ -150,14 +294,12 @@ class File(Base, bob.db.base.File):
       raise RuntimeError("%s is not an attack" % self)
     return self.attack[0]
 
-  def load(self, directory=None, extension=None):
+  def load(self, directory=None, extension=None, frames=None, nframes=None,
+           frame_cache=None):
     """Loads the data at the specified location and using the given extension.
 
     Keyword parameters:
 
-    data
-      The data blob to be saved (normally a :py:class:`numpy.ndarray`).
-
     directory
       [optional] If not empty or None, this directory is prefixed to the final
       file destination
@@ -165,30 +307,273 @@ class File(Base, bob.db.base.File):
     extension
       [optional] The extension of the filename - this will control the type of
       output and the codec for saving the input blob.
+
+    frames
+      [optional] Loads only some frames of the video: either a
+      :py:class:`slice` (e.g. ``slice(None, None, 10)`` for every 10th frame)
+      or a sequence of frame indices. Frames are returned in the given order.
+
+    nframes
+      [optional] Loads only this number of uniformly spaced frames, including
+      the first and the last ones. Cannot be used together with ``frames``.
+
+    frame_cache
+      [optional] A :py:class:`.FrameCache` (or its directory) from which
+      loaded data are served and in which they are stored. Data served from
+      the cache are read-only memory-mapped arrays.
+
+    When loading a selection of frames from a ``.mov`` file, only the selected
+    frames are allocated and decoding stops after the last one of them.
     """
     if extension is None:
-        extension = '.mov'
+      extension = '.mov'
     vfn = self.make_path(directory, extension)
+    selected = frames is not None or nframes is not None
+
+    cache = frame_cache
+    if cache is not None and not isinstance(cache, FrameCache):
+      cache = FrameCache(cache)
+    if cache is not None:
+      vin = cache.get(self, filename=vfn)
+      if vin is not None:
+        return vin[frame_indices(len(vin), frames, nframes)] if selected \
+            else vin
+      if selected:
+        vin = cache.get(self, filename=vfn, frames=frames, nframes=nframes)
+        if vin is not None:
+          return vin
+
+    if selected:
+      if extension == '.mov':
+        vin = load_frames(vfn, frames, nframes)
+      else:
+        vin = bob.io.base.load(vfn)
+        vin = vin[frame_indices(len(vin), frames, nframes)]
+
+    elif extension == '.mov':
+      video = bob.io.video.reader(vfn)
+      vin = video.load()
+    else:
+      vin = bob.io.base.load(vfn)
+
+    if cache is not None:
+      cache.put(self, vin, filename=vfn, frames=frames, nframes=nframes)
+
+    return vin
+
+  def frames(self, directory=None, extension=None, chunk=None,
+             with_index=False, frames=None, nframes=None, frame_cache=None):
+    """Iterates over the frames of the video, decoding them on demand.
+
+    Contrary to :py:meth:`load`, frames are decoded and yielded one at a time
+    (or in chunks of fixed size), so that processing may start with the first
+    frame and peak memory usage is bounded by the chunk size.
+
+    Keyword parameters:
+
+    directory
+      [optional] If not empty or None, this directory is prefixed to the final
+      file destination
+
+    extension
+      [optional] The extension of the filename. Files with extension
+      ``'.mov'`` (the default) are streamed from the video decoder. Other
+      files are loaded with :py:func:`bob.io.base.load` and then iterated.
+
+    chunk
+      [optional] If not set, frames are yielded one by one, as
+      :py:class:`numpy.ndarray` objects with shape ``(3, height, width)``.
+      Otherwise, they are grouped in arrays of shape ``(chunk, 3, height,
+      width)``, the last one possibly with less frames.
+
+    with_index
+      [optional] If set, yields tuples with the index of the (first) frame and
+      the frame (or chunk), instead of the frames alone.
+
+    frames, nframes
+      [optional] Iterates only over a selection of frames, as for
+      :py:meth:`load`. Selected frames are yielded in increasing order, each
+      one once, and decoding stops after the last one of them.
+
+    frame_cache
+      [optional] A :py:class:`.FrameCache` (or its directory). If it holds
+      the whole video, frames are served from it. Streamed frames are never
+      added to the cache.
+    """
+    if extension is None:
+      extension = '.mov'
+    filename = self.make_path(directory, extension)
+
+    cache = frame_cache
+    if cache is not None and not isinstance(cache, FrameCache):
+      cache = FrameCache(cache)
+    if cache is not None:
+      data = cache.get(self, filename=filename)
+      if data is not None:
+        return iter_array(data, chunk, with_index, frames, nframes)
 
     if extension == '.mov':
-        video = bob.io.video.reader(self.make_path(directory, extension))
-        vin = video.load()
+      return iter_frames(filename, chunk, with_index, frames, nframes)
+    return iter_array(bob.io.base.load(filename), chunk, with_index, frames,
+                      nframes)
+
+  def load_faces(self, directory=None, extension=None, size=64, gray=False,
+                 frames=None, nframes=None, fill='ffill', bbx_directory=None,
+                 cache=None, store=None, chunk=32, with_index=False,
+                 frame_cache=None):
+    """Loads face crops of fixed size from the frames of the video
+
+    Frames are decoded in chunks and only the face region of each one is
+    kept, after being resized with bilinear interpolation, so that full
+    frames are never accumulated in memory.
+
+    Keyword parameters:
+
+    directory, extension
+      [optional] Where to find the video, as for :py:meth:`load`
+
+    size
+      [optional] The side of the (square) face crops
+
+    gray
+      [optional] If set, crops are converted to gray-scale
+
+    frames, nframes
+      [optional] Crops faces only on a selection of frames, as for
+      :py:meth:`load`. Crops are returned in the order of the selection
+      (indices may repeat); each selected frame is decoded once.
+
+    fill
+      [optional] How frames without a face detection are handled (see
+      :py:meth:`dense_bbx`). By default, the last detected face location is
+      used. If set to ``None``, frames without a detection are skipped.
+
+    bbx_directory
+      [optional] The directory where face locations are looked for (see
+      :py:meth:`bbx`). If not set, ``directory`` is used.
+
+    cache, store
+      [optional] Where to read face locations from, as for :py:meth:`bbx`
+
+    chunk
+      [optional] The number of frames decoded at once
+
+    with_index
+      [optional] If set, returns a tuple with the indices of the frames the
+      crops were taken from and the crops, instead of the crops alone
+
+    frame_cache
+      [optional] A :py:class:`.FrameCache` (or its directory) from which crops
+      are served and in which they are stored. Frames are also read from it
+      if it holds the whole video.
+
+    Returns a :py:class:`numpy.ndarray` of unsigned 8-bit integers with shape
+    ``(n, 3, size, size)`` or, for gray-scale crops, ``(n, size, size)``.
+    If the video holds less frames than its header tells, frames that could
+    not be decoded are left out.
+    """
+    from .faces import crop_faces
+
+    if extension is None:
+      extension = '.mov'
+    filename = self.make_path(directory, extension)
+
+    if bbx_directory is None:
+      bbx_directory = directory
+
+    if frame_cache is not None and not isinstance(frame_cache, FrameCache):
+      frame_cache = FrameCache(frame_cache)
+    data = None
+    if frame_cache is not None:
+      # crops depend on the video and on where face locations come from
+      options = dict(filename=filename, size=size, gray=gray, frames=frames,
+                     nframes=nframes, fill=fill,
+                     bbx_file=self.facefile(bbx_directory),
+                     bbx_cache=cache, bbx_store=getattr(store, 'directory',
+                                                        store))
+      retval = frame_cache.get(self, kind='faces', **options)
+      indices = frame_cache.get(self, kind='faces-index', **options)
+      if retval is not None and indices is not None:
+        return (indices, retval) if with_index else retval
+      data = frame_cache.get(self, filename=filename)
+
+    video = None
+    if data is not None:
+      n_frames = len(data)
+    elif extension == '.mov':
+      video = bob.io.video.reader(filename)
+      n_frames = len(video)
     else:
-        vin =  bob.io.base.load(self.make_path(directory, extension))
+      data = bob.io.base.load(filename)
+      n_frames = len(data)
+
+    boxes, detected = self.dense_bbx(bbx_directory, n_frames, fill, cache,
+                                     store)
+    if fill is not None and detected.any():
+      detected[:] = True  # all frames have a (filled) bounding box
+
+    indices = frame_indices(n_frames, frames, nframes)
+    if indices is None:
+      indices = numpy.arange(n_frames)
+    indices = indices[detected[indices]]
+
+    # frames are decoded in increasing order, each one once
+    unique, inverse = numpy.unique(indices, return_inverse=True)
+    ordered = len(unique) == len(indices) and (unique == indices).all()
+    shape = (len(unique), size, size) if gray else \
+        (len(unique), 3, size, size)
+    retval = numpy.empty(shape, dtype=numpy.uint8)
+
+    if data is None:
+      stream = iter_video(video, chunk or 1, frames=unique)
+    else:
+      stream = iter_array(data, chunk or 1, frames=unique)
+
+    start = 0
+    for k in stream:
+      stop = start + len(k)
+      crop_faces(k, boxes[unique[start:stop]], size, gray,
+                 retval[start:stop])
+      start = stop
+
+    if start < len(unique):  # the video holds less frames than announced
+      decoded = inverse < start
+      indices = indices[decoded]
+      inverse = inverse[decoded]
+      retval = retval[:start]
+
+    if not ordered:
+      retval = retval[inverse]  # back to the order of the selection
+
+    if frame_cache is not None:
+      frame_cache.put(self, retval, kind='faces', **options)
+      frame_cache.put(self, indices, kind='faces-index', **options)
 
-    return vin #bob.io.base.load(self.make_path(directory, extension))
+    if with_index:
+      return indices, retval
+    return retval
 
 
 # Intermediate mapping from RealAccess's to Protocol's
 realaccesses_protocols = Table('realaccesses_protocols', Base.metadata,
                                Column('realaccess_id', Integer, ForeignKey('realaccess.id')),
                                Column('protocol_id', Integer, ForeignKey('protocol.id')),
+                               # joins from either side, without touching rows
+                               Index('ix_realaccesses_protocols_realaccess',
+                                     'realaccess_id', 'protocol_id'),
+                               Index('ix_realaccesses_protocols_protocol',
+                                     'protocol_id', 'realaccess_id'),
                                )
 
 # Intermediate mapping from Attack's to Protocol's
 attacks_protocols = Table('attacks_protocols', Base.metadata,
                           Column('attack_id', Integer, ForeignKey('attack.id')),
                           Column('protocol_id', Integer, ForeignKey('protocol.id')),
+                          # joins from either side, without touching rows
+                          Index('ix_attacks_protocols_attack',
+                                'attack_id', 'protocol_id'),
+                          Index('ix_attacks_protocols_protocol',
+                                'protocol_id', 'attack_id'),
                           )
 
 
@@ -221,10 +606,10 @@ class RealAccess(Base):
   id = Column(Integer, primary_key=True)
   """Unique identifier for this real-access object"""
 
-  file_id = Column(Integer, ForeignKey('file.id'))  # for SQL
+  file_id = Column(Integer, ForeignKey('file.id'), index=True)  # for SQL
   """The file identifier the current real-access is bound to"""
 
-  purpose = Column(Enum(*purpose_choices))
+  purpose = Column(CodedEnum(*purpose_choices), index=True)
   """The purpose of this video"""
 
   take = Column(Integer)
@@ -267,19 +652,19 @@ class Attack(Base):
   id = Column(Integer, primary_key=True)
   """Unique identifier for this attack"""
 
-  file_id = Column(Integer, ForeignKey('file.id'))  # for SQL
+  file_id = Column(Integer, ForeignKey('file.id'), index=True)  # for SQL
   """The file identifier this attack is linked to"""
 
-  attack_support = Column(Enum(*attack_support_choices))
+  attack_support = Column(CodedEnum(*attack_support_choices), index=True)
   """The attack support"""
 
-  attack_device = Column(Enum(*attack_device_choices))
+  attack_device = Column(CodedEnum(*attack_device_choices))
   """The attack device"""
 
-  sample_type = Column(Enum(*sample_type_choices))
+  sample_type = Column(CodedEnum(*sample_type_choices))
   """The attack sample type"""
 
-  sample_device = Column(Enum(*sample_device_choices))
+  sample_device = Column(CodedEnum(*sample_device_choices))
   """The attack sample device"""
 
   # for Python
@@ -299,3 +684,25 @@ class Attack(Base):
 
   def __repr__(self):
     return "<Attack('%s')>" % (self.file.path)
+
+
+class ListFile(Base):
+  """Content hash of one of the file lists the database was created from"""
+
+  __tablename__ = 'listfile'
+
+  id = Column(Integer, primary_key=True)
+  """Unique identifier for this list"""
+
+  name = Column(String(100), unique=True)
+  """The name of the list, relative to the protocol directory"""
+
+  digest = Column(String(40))
+  """The SHA-1 digest (hexadecimal) of the list contents"""
+
+  def __init__(self, name, digest):
+    self.name = name
+    self.digest = digest
+
+  def __repr__(self):
+    return "ListFile('%s', '%s')" % (self.name, self.digest)
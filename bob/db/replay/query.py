@@ -8,30 +8,203 @@ replay attack database in the most obvious ways.
 """
 
 import os
+import collections
 from bob.db.base import utils, SQLiteDatabase
 from .models import *
 from .driver import Interface
+from .index import MetadataIndex, PathIndex
 
 INFO = Interface()
 
 SQLITE_FILE = INFO.files()[0]
 
+VALID_CLASSES = ('real', 'attack', 'enroll')
+"""Classes of data that can be retrieved through :py:meth:`.Database.objects`"""
+
+QUERY_MODES = ('sql', 'union', 'index')
+"""Possible strategies for answering :py:meth:`.Database.objects` queries"""
+
+REVERSE_MATCHES = ('stem', 'basename', 'glob')
+"""Ways to match paths in :py:meth:`.Database.reverse`"""
+
+FACETS = ('cls', 'protocol', 'group', 'light', 'client', 'support', 'device',
+          'sample_type', 'sample_device')
+"""Attributes by which :py:meth:`.Database.facets` can group files"""
+
+SQLITE_MAX_VARIABLES = 900
+"""Maximum number of values bound to a single SQL statement (SQLite limits
+it to 999 by default)"""
+
+
+def _chunks(sequence, size):
+  """Splits a sequence in consecutive slices of at most ``size`` elements"""
+  for i in range(0, len(sequence), size):
+    yield sequence[i:i + size]
+
+
+def _filter_attacks(q, support, device, sample_type, sample_device):
+  """Restricts a query joined with :py:class:`.Attack` to the given attack
+  attributes, each one being ``None`` (no filtering) or a list of values"""
+
+  if support:
+    q = q.filter(Attack.attack_support.in_(support))
+  if device:
+    q = q.filter(Attack.attack_device.in_(device))
+  if sample_type:
+    q = q.filter(Attack.sample_type.in_(sample_type))
+  if sample_device:
+    q = q.filter(Attack.sample_device.in_(sample_device))
+  return q
+
+
+def _eager_options():
+  """Returns the loader options fetching the client, real-access and attack
+  of files together with them, as used by the ``'union'`` query mode"""
+
+  from sqlalchemy.orm import joinedload, selectinload
+
+  return (joinedload(File.client), selectinload(File.realaccess),
+          selectinload(File.attack))
+
+
+def _check_validity(l, obj, valid, default):
+  """Checks validity of user input data against a set of valid values"""
+  if not l:
+    return default
+  elif not isinstance(l, (tuple, list)):
+    return _check_validity((l,), obj, valid, default)
+  for k in l:
+    if k not in valid:
+      if isinstance(valid, (set, frozenset, dict)):
+        valid = tuple(sorted(valid))
+      raise RuntimeError(
+          'Invalid %s "%s". Valid values are %s, or lists/tuples of those' % (obj, k, valid))
+  return l
+
 
 class Database(SQLiteDatabase):
   """The dataset class opens and maintains a connection opened to the Database.
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
+
+  Keyword parameters:
+
+  original_directory
+    The directory where the original data of the database are stored
+
+  original_extension
+    The file name extension of the original data
+
+  mode
+    The strategy used to answer :py:meth:`.Database.objects` queries. With
+    ``'sql'`` (the default), every query is run against the SQLite database,
+    with one statement per class of files. With ``'union'``, the selections
+    of all classes are combined in a single ``UNION`` statement and the
+    client, real-access and attack of the returned files are loaded eagerly,
+    so that accessing them issues no further queries. With ``'index'``, the
+    metadata of all files is loaded once, on the first query, into an
+    in-memory :py:class:`.MetadataIndex` that answers all subsequent queries
+    without any SQL round-trip.
+
+  sqlite_file
+    [optional] The SQLite file to open, instead of the one installed with
+    this package
+
+  memoize
+    [optional] If set to a positive number, the identifiers of the files
+    returned by :py:meth:`.Database.objects`, :py:meth:`.Database.records`
+    and :py:meth:`.Database.count` are memoized for up to this number of
+    distinct queries, the least recently used ones being evicted first.
+    Queries are compared after normalization: e.g., ``groups='devel'`` and
+    ``groups=('devel',)`` are the same, and so are all permutations of a
+    tuple of values. Memoized results are discarded if the SQLite file
+    changes. See :py:meth:`.Database.memo_info`.
   """
 
   def __init__(self, original_directory=None, original_extension=None,
-               **kwargs):
+               mode='sql', sqlite_file=None, memoize=0, **kwargs):
     super(Database, self).__init__(
-        SQLITE_FILE, File, original_directory, original_extension, **kwargs)
+        sqlite_file or SQLITE_FILE, File, original_directory,
+        original_extension, **kwargs)
+
+    if self.m_session is not None:
+      set_compact(self.m_session.bind)  # detects the layout of enumerations
+
+    if mode not in QUERY_MODES:
+      raise RuntimeError('Invalid query mode "%s". Valid values are %s' %
+                         (mode, QUERY_MODES))
+    self.m_mode = mode
+    self.m_index = None
+    self.m_path_index = None
+    self.m_vocabulary = None
+    self.m_memoize = memoize
+    self.m_memo = collections.OrderedDict()  # query key -> file identifiers
+    self.m_memo_hits = 0
+    self.m_memo_misses = 0
+
+  def _signature(self):
+    """Returns the modification time and size of the SQLite file, which
+    identify the current state of the database"""
+
+    stat = os.stat(self.m_sqlite_file)
+    return (stat.st_mtime, stat.st_size)
+
+  def _vocabulary(self):
+    """Returns the cached vocabulary of protocol names and client identifiers
+
+    The vocabulary is a dictionary with the following keys:
+
+    ``protocols``
+      A :py:class:`frozenset` with the names of all protocols
+
+    ``clients``
+      A dictionary mapping each client identifier to the set it belongs to
+
+    It is loaded from the database on the first call and re-loaded whenever
+    the SQLite file changes on disk (i.e., if its modification time or size
+    changes). In this case, the in-memory indexes are also discarded.
+    """
+
+    signature = self._signature()
+
+    if self.m_vocabulary is None or \
+            self.m_vocabulary['signature'] != signature:
+      if self.m_vocabulary is not None:
+        # the database changed under our feet, reload everything
+        self.m_session.expire_all()
+        self.m_index = None
+        self.m_path_index = None
+        self.m_memo.clear()
+      self.m_vocabulary = dict(
+          signature=signature,
+          protocols=frozenset(
+              k[0] for k in self.m_session.query(Protocol.name)),
+          clients=dict(self.m_session.query(Client.id, Client.set)),
+      )
+
+    return self.m_vocabulary
+
+  def _metadata_index(self):
+    """Returns the in-memory metadata index, building it on the first call"""
+
+    self._vocabulary()  # discards the index if the database has changed
+    if self.m_index is None:
+      self.m_index = MetadataIndex(self.m_session)
+    return self.m_index
+
+  def _reverse_index(self):
+    """Returns the in-memory path index, building it on the first call"""
+
+    self._vocabulary()  # discards the index if the database has changed
+    if self.m_path_index is None:
+      self.m_path_index = PathIndex(self.m_session)
+    return self.m_path_index
 
   def objects(self, support=Attack.attack_support_choices,
               protocol='grandtest', groups=Client.set_choices, cls=('attack', 'real'),
-              light=File.light_choices, clients=None):
+              light=File.light_choices, clients=None, device=None,
+              sample_type=None, sample_device=None):
     """Returns a list of unique :py:class:`.File` objects for the specific
     query by the user.
 
@@ -67,49 +240,277 @@ class Database(SQLiteDatabase):
       client identifiers from which files should be retrieved. If ommited, set
       to None or an empty list, then data from all clients is retrieved.
 
+    device
+      One of the attack devices as returned by attack_devices() or a
+      combination of them (in a tuple). If not set, attacks with any device
+      are retrieved.
+
+    sample_type
+      One of the sample types as returned by attack_sample_types() or a
+      combination of them (in a tuple). If not set, attacks with any sample
+      type are retrieved.
+
+    sample_device
+      One of the sampling devices as returned by attack_sampling_devices() or
+      a combination of them (in a tuple). If not set, attacks with any
+      sampling device are retrieved.
+
+    Like ``support``, these filters only restrict attacks: real accesses and
+    enrollment data are not affected by them. They are evaluated inside the
+    SQL query (or by the in-memory index), not on the returned objects.
+
     Returns: A list of :py:class:`.File` objects.
     """
 
     self.assert_validity()
 
-    def check_validity(l, obj, valid, default):
-      """Checks validity of user input data against a set of valid values"""
-      if not l:
-        return default
-      elif not isinstance(l, (tuple, list)):
-        return check_validity((l,), obj, valid, default)
-      for k in l:
-        if k not in valid:
-          raise RuntimeError(
-              'Invalid %s "%s". Valid values are %s, or lists/tuples of those' % (obj, k, valid))
-      return l
+    query = self._query_arguments(support, protocol, groups, cls, light,
+                                  clients, device, sample_type, sample_device)
+
+    if self.m_memoize:
+      return self._objects_by_id(self._memoized_ids(query))
+
+    if self.m_mode == 'index':
+      return self._metadata_index().objects(**query)
+
+    if self.m_mode == 'union':
+      return self._union_objects(**query)
+
+    return self._sql_objects(**query)
+
+  def _memo_key(self, query):
+    """Returns a canonical, hashable representation of a (validated) query
+
+    Lists of values are turned into sorted tuples without repetitions, and
+    lists covering all possible values of an attribute are replaced by
+    ``None`` (no filtering), which returns the same files.
+    """
+
+    everything = dict(support=self.attack_supports(), groups=self.groups(),
+                      light=self.lights(), device=self.attack_devices(),
+                      sample_type=self.attack_sample_types(),
+                      sample_device=self.attack_sampling_devices())
+
+    retval = []
+    for name in sorted(query):
+      value = query[name]
+      if value is not None:
+        value = tuple(sorted(set(value)))
+        if name in everything and set(value) == set(everything[name]):
+          value = None
+      retval.append((name, value))
+    return tuple(retval)
+
+  def _memoized_ids(self, query):
+    """Returns the identifiers of the files matching a (validated) query,
+    from the memo if possible"""
+
+    key = self._memo_key(query)
+
+    if key in self.m_memo:
+      self.m_memo_hits += 1
+      self.m_memo.move_to_end(key)
+      return self.m_memo[key]
+
+    self.m_memo_misses += 1
+    retval = tuple(self._file_ids(**query))
+    self.m_memo[key] = retval
+    while len(self.m_memo) > self.m_memoize:
+      self.m_memo.popitem(last=False)
+    return retval
+
+  def _objects_by_id(self, ids):
+    """Returns the :py:class:`.File` objects with the given identifiers, in
+    the same order. Objects already in the session are not queried again."""
+
+    if self.m_mode == 'index':
+      files = self._metadata_index().m_files
+      return [files[k] for k in ids]
+
+    from sqlalchemy import inspect
+    from sqlalchemy.orm.util import identity_key
+
+    # in 'union' mode, files come with their relationships already loaded
+    eager = self.m_mode == 'union'
+    related = set(('client', 'realaccess', 'attack'))
+
+    identity_map = self.m_session.identity_map
+    files = {}
+    missing = []
+    for k in ids:
+      f = identity_map.get(identity_key(File, k))
+      if f is None or (eager and related & inspect(f).unloaded):
+        missing.append(k)
+      else:
+        files[k] = f
+
+    for chunk in _chunks(missing, SQLITE_MAX_VARIABLES):
+      q = self.m_session.query(File).filter(File.id.in_(chunk))
+      if eager:
+        q = q.options(*_eager_options())
+      for f in q:
+        files[f.id] = f
+
+    return [files[k] for k in ids]
+
+  def memo_info(self):
+    """Returns statistics about the memoization of query results
+
+    The returned dictionary has the keys ``hits`` and ``misses`` (the number
+    of queries answered from the memo or not), ``size`` (the number of
+    queries currently memoized) and ``max_size`` (the ``memoize`` parameter
+    of the database).
+    """
+
+    return dict(hits=self.m_memo_hits, misses=self.m_memo_misses,
+                size=len(self.m_memo), max_size=self.m_memoize)
+
+  def clear_memo(self):
+    """Discards all memoized query results and resets the statistics"""
+
+    self.m_memo.clear()
+    self.m_memo_hits = 0
+    self.m_memo_misses = 0
+
+  def iter_objects(self, support=Attack.attack_support_choices,
+                   protocol='grandtest', groups=Client.set_choices,
+                   cls=('attack', 'real'), light=File.light_choices,
+                   clients=None, device=None, sample_type=None,
+                   sample_device=None, batch_size=1000):
+    """Returns an iterator over the :py:class:`.File` objects matching a
+    query, which does not build the list of all of them first.
+
+    Files are yielded in the same order as returned by
+    :py:meth:`.Database.objects`. Rows are fetched from a single ``UNION``
+    statement in batches of ``batch_size``, so that the first files are
+    available as soon as the first batch is read and only one batch of rows
+    is buffered at any time, which matters for large derived databases. In
+    ``'index'`` mode, files are taken from the in-memory index instead.
+
+    Keyword parameters are those of :py:meth:`.Database.objects`, plus:
+
+    batch_size
+      The number of rows fetched from the database at once
+
+    Relationships of the yielded files (e.g. :py:meth:`.File.get_attack`)
+    are loaded lazily, when accessed.
+    """
+
+    if batch_size < 1:
+      raise RuntimeError("The batch size must be positive, but got %d" % batch_size)
+
+    self.assert_validity()
+
+    # arguments are validated now, not when iteration starts
+    query = self._query_arguments(support, protocol, groups, cls, light,
+                                  clients, device, sample_type, sample_device)
+
+    if self.m_mode == 'index':
+      return iter(self._metadata_index().objects(**query))
+
+    # UNION removes files linked to multiple protocols: no duplicates here
+    selection = self._union_selection(**query)
+    q = self.m_session.query(File).join(
+        selection, File.id == selection.c.file_id)
+    q = q.order_by(selection.c.cls_order, File.client_id, File.id)
+    return iter(q.yield_per(batch_size))
+
+  def _query_arguments(self, support, protocol, groups, cls, light, clients,
+                       device=None, sample_type=None, sample_device=None):
+    """Validates and normalizes the user input to :py:meth:`.objects`
+
+    Returns a dictionary with the keys ``support``, ``protocol``, ``groups``,
+    ``cls``, ``light``, ``clients``, ``device``, ``sample_type`` and
+    ``sample_device``, in which every value is either ``None`` (meaning "do
+    not filter") or a tuple/list of valid values.
+    """
+
+    vocabulary = self._vocabulary()
 
     # check if groups set are valid
-    VALID_GROUPS = self.groups()
-    groups = check_validity(groups, "group", VALID_GROUPS, None)
+    groups = _check_validity(groups, "group", self.groups(), None)
 
     # check if supports set are valid
-    VALID_SUPPORTS = self.attack_supports()
-    support = check_validity(support, "support", VALID_SUPPORTS, None)
+    support = _check_validity(support, "support", self.attack_supports(),
+                              None)
 
     # by default, do NOT grab enrollment data from the database
-    VALID_CLASSES = ('real', 'attack', 'enroll')
-    cls = check_validity(cls, "class", VALID_CLASSES, ('real', 'attack'))
+    cls = _check_validity(cls, "class", VALID_CLASSES, ('real', 'attack'))
 
     # check protocol validity
     if not protocol:
       protocol = 'grandtest'  # default
-    VALID_PROTOCOLS = [k.name for k in self.protocols()]
-    protocol = check_validity(
-        protocol, "protocol", VALID_PROTOCOLS, ('grandtest',))
+    protocol = _check_validity(protocol, "protocol", vocabulary['protocols'],
+                               ('grandtest',))
 
     # checks client identity validity
-    VALID_CLIENTS = [k.id for k in self.clients()]
-    clients = check_validity(clients, "client", VALID_CLIENTS, None)
+    clients = _check_validity(clients, "client", vocabulary['clients'], None)
 
     # checks if the light is valid
-    VALID_LIGHTS = self.lights()
-    light = check_validity(light, "light", VALID_LIGHTS, None)
+    light = _check_validity(light, "light", self.lights(), None)
+
+    # checks the other attack attributes
+    device = _check_validity(device, "device", self.attack_devices(), None)
+    sample_type = _check_validity(sample_type, "sample type",
+                                  self.attack_sample_types(), None)
+    sample_device = _check_validity(sample_device, "sample device",
+                                    self.attack_sampling_devices(), None)
+
+    return dict(support=support, protocol=protocol, groups=groups, cls=cls,
+                light=light, clients=clients, device=device,
+                sample_type=sample_type, sample_device=sample_device)
+
+  def _union_selection(self, support, protocol, groups, cls, light,
+                       clients, device, sample_type, sample_device):
+    """Returns the union of per-class selections answering the
+    :py:meth:`.objects` query, with columns ``file_id`` and ``cls_order``"""
+
+    from sqlalchemy import union, literal
+
+    # one sub-select per class, each tagged with its position in the output
+    selects = []
+    for order, c in enumerate(('enroll', 'real', 'attack')):
+      if c not in cls:
+        continue
+
+      q = self.m_session.query(File.id.label('file_id'),
+                               literal(order).label('cls_order'))
+      q = q.select_from(File)
+      if c == 'enroll':
+        q = q.join(RealAccess).filter(RealAccess.purpose == 'enroll')
+      elif c == 'real':
+        q = q.join(RealAccess).join(RealAccess.protocols)
+        q = q.filter(Protocol.name.in_(protocol))
+      else:
+        q = q.join(Attack).join(Attack.protocols)
+        q = q.filter(Protocol.name.in_(protocol))
+        q = _filter_attacks(q, support, device, sample_type, sample_device)
+      if groups:
+        q = q.join(Client).filter(Client.set.in_(groups))
+      if clients:
+        q = q.filter(File.client_id.in_(clients))
+      if light:
+        q = q.filter(File.light.in_(light))
+      selects.append(q.statement)
+
+    # UNION (and not UNION ALL) removes files linked to multiple protocols
+    return union(*selects).alias('selection')
+
+  def _union_objects(self, **query):
+    """Runs the :py:meth:`.objects` query as a single statement, eagerly
+    loading the relationships of the returned files"""
+
+    selection = self._union_selection(**query)
+
+    q = self.m_session.query(File).join(
+        selection, File.id == selection.c.file_id)
+    q = q.options(*_eager_options())
+    q = q.order_by(selection.c.cls_order, File.client_id, File.id)
+    return list(q)
+
+  def _sql_objects(self, support, protocol, groups, cls, light, clients,
+                   device, sample_type, sample_device):
+    """Runs the :py:meth:`.objects` query against the SQLite database"""
 
     # now query the database
     retval = []
@@ -124,7 +525,7 @@ class Database(SQLiteDatabase):
       if light:
         q = q.filter(File.light.in_(light))
       q = q.filter(RealAccess.purpose == 'enroll')
-      q = q.order_by(Client.id)
+      q = q.order_by(Client.id, File.id)
       retval += list(q)
 
     # real-accesses are simpler to query
@@ -138,7 +539,7 @@ class Database(SQLiteDatabase):
       if light:
         q = q.filter(File.light.in_(light))
       q = q.filter(Protocol.name.in_(protocol))
-      q = q.order_by(Client.id)
+      q = q.order_by(Client.id, File.id)
       retval += list(q)
 
     # attacks will have to be filtered a little bit more
@@ -149,16 +550,325 @@ class Database(SQLiteDatabase):
         q = q.filter(Client.set.in_(groups))
       if clients:
         q = q.filter(Client.id.in_(clients))
-      if support:
-        q = q.filter(Attack.attack_support.in_(support))
+      q = _filter_attacks(q, support, device, sample_type, sample_device)
       if light:
         q = q.filter(File.light.in_(light))
       q = q.filter(Protocol.name.in_(protocol))
-      q = q.order_by(Client.id)
+      q = q.order_by(Client.id, File.id)
       retval += list(q)
 
     return retval
 
+  def count(self, support=Attack.attack_support_choices,
+            protocol='grandtest', groups=Client.set_choices,
+            cls=('attack', 'real'), light=File.light_choices, clients=None,
+            device=None, sample_type=None, sample_device=None):
+    """Returns the number of files :py:meth:`.Database.objects` would return
+    for the same query, without loading any :py:class:`.File` object.
+
+    Keyword parameters are those of :py:meth:`.Database.objects`. The count
+    is computed by a single ``SELECT COUNT(*)`` statement (or by the
+    in-memory index, in ``'index'`` mode).
+    """
+
+    from sqlalchemy import func
+
+    self.assert_validity()
+
+    query = self._query_arguments(support, protocol, groups, cls, light,
+                                  clients, device, sample_type, sample_device)
+
+    if self.m_memoize:
+      return len(self._memoized_ids(query))
+
+    if self.m_mode == 'index':
+      return len(self._metadata_index().file_ids(**query))
+
+    selection = self._union_selection(**query)
+    return self.m_session.query(func.count()).select_from(selection).scalar()
+
+  def facets(self, by, support=Attack.attack_support_choices,
+             protocol='grandtest', groups=Client.set_choices,
+             cls=('attack', 'real'), light=File.light_choices, clients=None,
+             device=None, sample_type=None, sample_device=None):
+    """Counts the files matching a query, grouped by some of their attributes.
+
+    Counts are computed in SQL, with ``COUNT``/``GROUP BY``, in one statement
+    per class of data, without loading any :py:class:`.File` object.
+
+    Keyword parameters:
+
+    by
+      One attribute, or a tuple of attributes, among those in
+      :py:data:`FACETS`: ``'cls'`` (the class of data: ``'enroll'``,
+      ``'real'`` or ``'attack'``), ``'protocol'``, ``'group'``, ``'light'``,
+      ``'client'`` (the client identifier), ``'support'``, ``'device'``,
+      ``'sample_type'`` and ``'sample_device'``. Attributes that do not apply
+      to a file (e.g., the attack device of a real access, or the protocol of
+      enrollment data) have value ``None``.
+
+    All remaining parameters are those of :py:meth:`.Database.objects`.
+
+    Returns: A dictionary mapping each combination of values of the ``by``
+    attributes (a tuple, or a single value if ``by`` is a string) to the
+    number of files having it. Unless grouping by ``'protocol'``, files in
+    multiple selected protocols are counted once, so that the sum of all
+    counts is :py:meth:`.Database.count` for the same query.
+    """
+
+    from sqlalchemy import func
+
+    self.assert_validity()
+
+    single = not isinstance(by, (tuple, list))
+    if single:
+      by = (by,)
+    for k in by:
+      if k not in FACETS:
+        raise RuntimeError('Invalid facet "%s". Valid values are %s' %
+                           (k, FACETS))
+
+    query = self._query_arguments(support, protocol, groups, cls, light,
+                                  clients, device, sample_type, sample_device)
+
+    columns = {
+        'group': Client.set,
+        'light': File.light,
+        'client': File.client_id,
+        'protocol': Protocol.name,
+        'support': Attack.attack_support,
+        'device': Attack.attack_device,
+        'sample_type': Attack.sample_type,
+        'sample_device': Attack.sample_device,
+    }
+    applies = {
+        'enroll': ('group', 'light', 'client'),
+        'real': ('group', 'light', 'client', 'protocol'),
+        'attack': ('group', 'light', 'client', 'protocol', 'support',
+                   'device', 'sample_type', 'sample_device'),
+    }
+
+    retval = {}
+    for c in ('enroll', 'real', 'attack'):
+      if c not in query['cls']:
+        continue
+
+      grouped = [k for k in by if k in applies[c]]
+      entities = [columns[k] for k in grouped]
+      q = self.m_session.query(*(entities + [func.count(File.id.distinct())]))
+      q = self._class_query(q, c, **query)
+      if entities:
+        q = q.group_by(*entities)
+
+      for row in q:
+        values = dict(zip(grouped, row[:-1]))
+        values['cls'] = c
+        key = tuple(values.get(k) for k in by)
+        if single:
+          key = key[0]
+        if row[-1]:
+          retval[key] = retval.get(key, 0) + row[-1]
+
+    return retval
+
+  def _class_query(self, q, c, support, protocol, groups, cls, light, clients,
+                   device, sample_type, sample_device):
+    """Joins and filters a query so that it selects the files of a single
+    class ``c`` matching the (validated) :py:meth:`.objects` query"""
+
+    q = q.select_from(File).join(Client)
+    if c == 'enroll':
+      q = q.join(RealAccess).filter(RealAccess.purpose == 'enroll')
+    elif c == 'real':
+      q = q.join(RealAccess).join(RealAccess.protocols)
+      q = q.filter(Protocol.name.in_(protocol))
+    else:
+      q = q.join(Attack).join(Attack.protocols)
+      q = q.filter(Protocol.name.in_(protocol))
+      q = _filter_attacks(q, support, device, sample_type, sample_device)
+    if groups:
+      q = q.filter(Client.set.in_(groups))
+    if clients:
+      q = q.filter(File.client_id.in_(clients))
+    if light:
+      q = q.filter(File.light.in_(light))
+    return q
+
+  def _file_ids(self, **query):
+    """Returns the identifiers of the files matching the (validated)
+    :py:meth:`.objects` query, in the same order, without loading any
+    :py:class:`.File` object"""
+
+    if self.m_mode == 'index':
+      return self._metadata_index().file_ids(**query)
+
+    selection = self._union_selection(**query)
+    q = self.m_session.query(File.id).join(
+        selection, File.id == selection.c.file_id)
+    q = q.order_by(selection.c.cls_order, File.client_id, File.id)
+    return [k[0] for k in q]
+
+  def records(self, support=Attack.attack_support_choices,
+              protocol='grandtest', groups=Client.set_choices,
+              cls=('attack', 'real'), light=File.light_choices, clients=None,
+              device=None, sample_type=None, sample_device=None):
+    """Returns a list of :py:class:`.FileRecord` objects for the specific
+    query by the user.
+
+    The query and the order of results are the same as for
+    :py:meth:`.Database.objects`, but files are returned as lightweight
+    records, detached from the database session, which are cheap to pickle
+    and to keep in memory. All metadata are fetched with a few bulk queries.
+
+    Keyword parameters are those of :py:meth:`.Database.objects`.
+
+    Returns: A list of :py:class:`.FileRecord` objects.
+    """
+
+    self.assert_validity()
+
+    query = self._query_arguments(support, protocol, groups, cls, light,
+                                  clients, device, sample_type, sample_device)
+    if self.m_memoize:
+      return self._records(self._memoized_ids(query))
+
+    return self._records(self._file_ids(**query))
+
+  def _records(self, ids):
+    """Returns the :py:class:`.FileRecord` objects of the files with the
+    given identifiers, in the same order"""
+
+    from .records import FileRecord
+
+    q = self._metadata_query()
+    rows = {}
+    for chunk in _chunks(ids, SQLITE_MAX_VARIABLES):
+      for row in q.filter(File.id.in_(chunk)):
+        rows[row[0]] = row
+
+    retval = []
+    for k in ids:
+      (id, path, client_id, group, light, purpose, take, support, device,
+       sample_type, sample_device) = rows[k]
+      if support is not None:
+        cls = 'attack'
+      elif purpose == 'enroll':
+        cls = 'enroll'
+      else:
+        cls = 'real'
+      retval.append(FileRecord(id, path, client_id, group, light, cls,
+                               purpose, take, support, device, sample_type,
+                               sample_device))
+    return retval
+
+  def _metadata_query(self):
+    """Returns a query over the metadata of all files, with a row per file
+    containing its identifier, path, client identifier, group, light, the
+    purpose and take of the real access and the support, device, sample type
+    and sample device of the attack (the latter ones being ``None`` for
+    files of the other kind)"""
+
+    q = self.m_session.query(File.id, File.path, File.client_id, Client.set,
+                             File.light, RealAccess.purpose, RealAccess.take,
+                             Attack.attack_support, Attack.attack_device,
+                             Attack.sample_type, Attack.sample_device)
+    return q.join(Client).outerjoin(RealAccess).outerjoin(Attack)
+
+  def columns(self, structured=False):
+    """Returns the metadata of all files in the database as NumPy arrays.
+
+    All metadata are read with a few bulk queries, without loading any
+    :py:class:`.File` object, and files are sorted by identifier. String
+    attributes which do not apply to a file (e.g., the attack device of a
+    real access) are empty strings, and the ``take`` of attacks is -1.
+
+    Keyword parameters:
+
+    structured
+      If set, returns a tuple with a single structured
+      :py:class:`numpy.ndarray`, with one record per file, and the names of
+      the protocols labelling its ``membership`` field. Otherwise (the
+      default), returns a dictionary of column arrays.
+
+    Returns: A dictionary with the following keys (or a structured array with
+    the following fields, except ``protocols``, and the protocols):
+
+    ``id``, ``client_id``, ``take``
+      Integer columns
+
+    ``group``, ``light``, ``purpose``, ``attack_support``,
+    ``attack_device``, ``sample_type``, ``sample_device``
+      String columns
+
+    ``is_real``
+      A boolean column, which is ``False`` for attacks
+
+    ``protocols``
+      The (sorted) names of all protocols in the database
+
+    ``membership``
+      A boolean matrix with one row per file and one column per protocol (in
+      the order of ``protocols``), telling if the file belongs to the
+      protocol. In a structured array, each record holds its row of this
+      matrix.
+    """
+
+    import numpy
+
+    self.assert_validity()
+
+    rows = self._metadata_query().order_by(File.id).all()
+    if rows:
+      (ids, paths, client_ids, groups, lights, purposes, takes, supports,
+       devices, sample_types, sample_devices) = zip(*rows)
+    else:
+      (ids, paths, client_ids, groups, lights, purposes, takes, supports,
+       devices, sample_types, sample_devices) = 11 * ((),)
+
+    def strings(values):
+      return numpy.array([k or '' for k in values], dtype=str)
+
+    retval = dict(
+        id=numpy.array(ids, dtype=numpy.int32),
+        client_id=numpy.array(client_ids, dtype=numpy.int32),
+        group=strings(groups),
+        light=strings(lights),
+        is_real=numpy.array([k is None for k in supports], dtype=bool),
+        purpose=strings(purposes),
+        take=numpy.array([-1 if k is None else k for k in takes],
+                         dtype=numpy.int32),
+        attack_support=strings(supports),
+        attack_device=strings(devices),
+        sample_type=strings(sample_types),
+        sample_device=strings(sample_devices),
+    )
+
+    # protocol membership, through both association tables
+    protocols = tuple(sorted(self._vocabulary()['protocols']))
+    column = dict((k, i) for i, k in enumerate(protocols))
+    row = dict((k, i) for i, k in enumerate(ids))
+    membership = numpy.zeros((len(ids), len(protocols)), dtype=bool)
+    for table in (RealAccess, Attack):
+      q = self.m_session.query(table.file_id, Protocol.name).select_from(
+          table).join(table.protocols)
+      for file_id, name in q:
+        membership[row[file_id], column[name]] = True
+    retval['membership'] = membership
+
+    if not structured:
+      retval['protocols'] = protocols
+      return retval
+
+    names = ('id', 'client_id', 'group', 'light', 'is_real', 'purpose',
+             'take', 'attack_support', 'attack_device', 'sample_type',
+             'sample_device')
+    dtype = [(k, retval[k].dtype) for k in names]
+    dtype.append(('membership', bool, (len(protocols),)))
+    array = numpy.empty(len(ids), dtype=dtype)
+    for k in names + ('membership',):
+      array[k] = retval[k]
+    return array, protocols
+
   def files(self, directory=None, extension=None, **object_query):
     """Returns a set of filenames for the specific query by the user.
 
@@ -191,6 +901,115 @@ class Database(SQLiteDatabase):
 
     return dict([(k.id, k.make_path(directory, extension)) for k in self.objects(**object_query)])
 
+  def load_batch(self, files=None, directory=None, extension=None,
+                 frames=None, nframes=None, workers=None, ordered=True,
+                 frame_cache=None, **object_query):
+    """Loads the data of many files in parallel, in a pool of processes.
+
+    Keyword parameters:
+
+    files
+      [optional] The :py:class:`.File` objects to load. If not set, the files
+      returned by :py:meth:`.Database.objects` for the remaining keyword
+      arguments are loaded.
+
+    directory, extension
+      [optional] Where the data are and how they are stored, as for
+      :py:meth:`.File.load`. Default to the original directory and extension
+      of the database.
+
+    frames, nframes
+      [optional] The selection of frames to load from every video, as for
+      :py:meth:`.File.load`
+
+    workers
+      [optional] The number of worker processes (one per CPU, if not set).
+      With ``0`` or ``1``, files are loaded serially, in this process.
+
+    ordered
+      [optional] If set (the default), results are yielded in the same order
+      as the files. Otherwise, they are yielded as soon as they are loaded.
+
+    frame_cache
+      [optional] A :py:class:`.FrameCache` (or its directory) consulted by
+      the workers, as for :py:meth:`.File.load`
+
+    object_query
+      All remaining arguments are passed to :py:meth:`.Database.objects`, if
+      ``files`` is not set.
+
+    Yields one :py:class:`.LoadResult` for every file. Files that cannot be
+    loaded do not stop the batch; their result holds the exception raised
+    instead of the data.
+    """
+
+    from .loader import load_batch
+
+    if files is None:
+      files = self.objects(**object_query)
+    elif object_query:
+      raise RuntimeError("Query arguments (%s) cannot be used together with `files'" % ', '.join(sorted(object_query)))
+
+    if directory is None:
+      directory = self.original_directory
+    if extension is None:
+      extension = self.original_extension
+
+    return load_batch(files, directory, extension, frames, nframes, workers,
+                      ordered, frame_cache=frame_cache)
+
+  def prefetch(self, files=None, directory=None, extension=None, frames=None,
+               nframes=None, frame_cache=None, **kwargs):
+    """Returns an iterator over the data of many files, which are decoded
+    ahead of the consumer in the background.
+
+    Keyword parameters:
+
+    files
+      [optional] The :py:class:`.File` objects to iterate over. If not set,
+      the files returned by :py:meth:`.Database.objects` are used.
+
+    directory, extension
+      [optional] Where the data are and how they are stored, as for
+      :py:meth:`.File.load`. Default to the original directory and extension
+      of the database.
+
+    frames, nframes
+      [optional] The selection of frames to load from every video, as for
+      :py:meth:`.File.load`
+
+    frame_cache
+      [optional] A :py:class:`.FrameCache` (or its directory) consulted by
+      the workers, as for :py:meth:`.File.load`
+
+    kwargs
+      The arguments ``chunk``, ``depth``, ``workers``, ``backend``,
+      ``shuffle``, ``seed`` and ``skip_errors`` are passed to
+      :py:class:`.Prefetcher`. All remaining ones are passed to
+      :py:meth:`.Database.objects`, if ``files`` is not set.
+
+    Returns a :py:class:`.Prefetcher`, which may be iterated over once per
+    epoch.
+    """
+
+    from .loader import Prefetcher
+
+    options = dict((k, kwargs.pop(k)) for k in ('chunk', 'depth', 'workers',
+        'backend', 'shuffle', 'seed', 'skip_errors') if k in kwargs)
+
+    if files is None:
+      files = self.objects(**kwargs)
+    elif kwargs:
+      raise RuntimeError("Query arguments (%s) cannot be used together with `files'" % ', '.join(sorted(kwargs)))
+
+    if directory is None:
+      directory = self.original_directory
+    if extension is None:
+      extension = self.original_extension
+
+    return Prefetcher(files, directory, extension, frames, nframes,
+                      frame_cache=frame_cache, **options)
+
   def clients(self):
     """Returns an iterable with all known clients"""
 
@@ -271,18 +1090,26 @@ class Database(SQLiteDatabase):
       stem.
 
     Returns a list (that may be empty) of the fully constructed paths given the
-    file ids.
+    file ids. Paths are returned in the same order as the input ids; ids that
+    are not in the database are omitted.
     """
 
     self.assert_validity()
 
-    fobj = self.m_session.query(File).filter(File.id.in_(ids))
-    retval = []
-    for p in ids:
-      retval.extend([k.make_path(prefix, suffix) for k in fobj if k.id == p])
-    return retval
+    ids = list(ids)
+
+    # a single pass over the database, in chunks that respect SQLite limits
+    stems = {}
+    for chunk in _chunks(list(set(ids)), SQLITE_MAX_VARIABLES):
+      q = self.m_session.query(File.id, File.path).filter(File.id.in_(chunk))
+      stems.update(q)
+
+    prefix = prefix or ''
+    suffix = suffix or ''
+    return [os.path.join(prefix, stems[k] + suffix) for k in ids
+            if k in stems]
 
-  def reverse(self, paths):
+  def reverse(self, paths, match='stem'):
     """Reverses the lookup: from certain stems, returning file ids
 
     Keyword Parameters:
@@ -291,14 +1118,51 @@ class Database(SQLiteDatabase):
       The filename stems I'll query for. This object should be a python
       iterable (such as a tuple or list)
 
-    Returns a list (that may be empty).
+    match
+      How each entry in ``paths`` is matched against the file stems in the
+      database. One of:
+
+      ``'stem'``
+        The entry must be the complete stem of a file (the default), e.g.
+        ``devel/real/client003_session02_webcam_authenticate_adverse_1``
+
+      ``'basename'``
+        The entry must be the last component of the stem of one or more
+        files, e.g. ``client003_session02_webcam_authenticate_adverse_1``
+
+      ``'glob'``
+        The entry is a shell-style pattern (see :py:mod:`fnmatch`) matched
+        against complete stems, e.g. ``devel/attack/hand/*``. Entries ending
+        in ``/`` are considered prefixes.
+
+    Returns a list (that may be empty) with the ids of the matched files, in
+    the order of ``paths``. Entries that do not match any file are omitted.
+    Entries matching multiple files contribute all of them, sorted by id
+    (basenames) or stem (patterns).
     """
 
     self.assert_validity()
 
-    fobj = self.m_session.query(File).filter(File.path.in_(paths))
+    if match not in REVERSE_MATCHES:
+      raise RuntimeError('Invalid match "%s". Valid values are %s' %
+                         (match, REVERSE_MATCHES))
+
+    paths = list(paths)
+
+    if match == 'stem':
+      # a single pass over the database, in chunks that respect SQLite limits
+      ids = {}
+      for chunk in _chunks(list(set(paths)), SQLITE_MAX_VARIABLES):
+        q = self.m_session.query(File.path, File.id).filter(
+            File.path.in_(chunk))
+        ids.update(q)
+      return [ids[k] for k in paths if k in ids]
+
+    index = self._reverse_index()
+    lookup = index.basename if match == 'basename' else index.glob
+    retval = []
     for p in paths:
-      retval.extend([k.id for k in fobj if k.path == p])
+      retval.extend(lookup(p))
     return retval
 
   def save_one(self, id, obj, directory, extension):
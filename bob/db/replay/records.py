@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Lightweight, session-detached records of the files of the Replay-Attack
+database.
+"""
+
+from .models import File
+
+RECORD_FIELDS = ('id', 'path', 'client_id', 'group', 'light', 'cls',
+                 'purpose', 'take', 'attack_support', 'attack_device',
+                 'sample_type', 'sample_device')
+"""Attributes of a :py:class:`FileRecord`, in constructor order"""
+
+
+class FileRecord(object):
+  """A plain record with the metadata of one file of the database
+
+  Contrary to :py:class:`.File`, records are not bound to a database
+  session: they hold all metadata of a file in a handful of slots, are
+  cheap to create and to pickle (e.g., to send them to worker processes)
+  and take little memory. They provide the same methods as
+  :py:class:`.File` to build paths and to load data and face locations.
+  Records are returned by :py:meth:`.Database.records`.
+
+  Keyword parameters:
+
+  id
+    The identifier of the file in the database
+
+  path
+    The (unique) path stem of the file inside the database
+
+  client_id
+    The identifier of the client in the file
+
+  group
+    The group (set) the client belongs to: ``'train'``, ``'devel'`` or
+    ``'test'``
+
+  light
+    The illumination condition: ``'controlled'`` or ``'adverse'``
+
+  cls
+    The class of the file: ``'enroll'``, ``'real'`` or ``'attack'``
+
+  purpose, take
+    For real accesses, the purpose of the recording and the take number;
+    ``None`` for attacks
+
+  attack_support, attack_device, sample_type, sample_device
+    For attacks, the attributes of the attack (see :py:class:`.Attack`);
+    ``None`` for real accesses
+  """
+
+  __slots__ = RECORD_FIELDS
+
+  def __init__(self, id, path, client_id, group, light, cls, purpose=None,
+               take=None, attack_support=None, attack_device=None,
+               sample_type=None, sample_device=None):
+    self.id = id
+    self.path = path
+    self.client_id = client_id
+    self.group = group
+    self.light = light
+    self.cls = cls
+    self.purpose = purpose
+    self.take = take
+    self.attack_support = attack_support
+    self.attack_device = attack_device
+    self.sample_type = sample_type
+    self.sample_device = sample_device
+
+  def __reduce__(self):
+    return (FileRecord, tuple(getattr(self, k) for k in RECORD_FIELDS))
+
+  def __repr__(self):
+    return "FileRecord('%s')" % self.path
+
+  def __eq__(self, other):
+    if not isinstance(other, FileRecord):
+      return NotImplemented
+    return all(getattr(self, k) == getattr(other, k) for k in RECORD_FIELDS)
+
+  def __ne__(self, other):
+    retval = self.__eq__(other)
+    return retval if retval is NotImplemented else not retval
+
+  def __hash__(self):
+    return hash((self.id, self.path))
+
+  def is_real(self):
+    """Returns True if this file belongs to a real access, False otherwise"""
+
+    return self.cls != 'attack'
+
+  # paths and data are handled exactly as for database files
+  make_path = File.make_path
+  videofile = File.videofile
+  facefile = File.facefile
+  bbx = File.bbx
+  dense_bbx = File.dense_bbx
+  load = File.load
+  frames = File.frames
+  load_faces = File.load_faces
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Prints the number of files in every protocol, group and condition.
+"""
+
+import sys
+import time
+
+# Driver API
+# ==========
+
+
+def stats(args):
+  """Prints a breakdown of the number of files in every protocol"""
+
+  from .query import Database
+  db = Database()
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  start = time.time()
+
+  protocols = args.protocol or sorted(k.name for k in db.protocols())
+  counts = db.facets(('protocol', 'group', 'light', 'cls', 'support'),
+                     protocol=protocols, cls=('enroll', 'real', 'attack'),
+                     light=args.light)
+
+  groups = db.groups()
+  lights = (args.light,) if args.light else db.lights()
+  columns = [('enroll', None), ('real', None)] + \
+      [('attack', k) for k in db.attack_supports()]
+  titles = ['enroll', 'real'] + \
+      ['attack-%s' % k for k in db.attack_supports()] + ['total']
+
+  for protocol in protocols:
+    output.write("Protocol '%s'\n" % protocol)
+    output.write('%-8s %-11s' % ('group', 'light'))
+    output.write(''.join(' %14s' % k for k in titles))
+    output.write('\n')
+
+    totals = [0] * len(columns)
+    for group in groups:
+      for light in lights:
+        row = []
+        for cls, support in columns:
+          # enrollment data do not belong to protocols
+          p = None if cls == 'enroll' else protocol
+          row.append(counts.get((p, group, light, cls, support), 0))
+        totals = [a + b for a, b in zip(totals, row)]
+        output.write('%-8s %-11s' % (group, light))
+        output.write(''.join(' %14d' % k for k in row + [sum(row)]))
+        output.write('\n')
+
+    output.write('%-8s %-11s' % ('total', ''))
+    output.write(''.join(' %14d' % k for k in totals + [sum(totals)]))
+    output.write('\n\n')
+
+  output.write('(computed in %.1f ms)\n' % (1000 * (time.time() - start)))
+
+  return 0
+
+
+def add_command(subparsers):
+  """Add specific subcommands that the action "stats" can use"""
+
+  from argparse import SUPPRESS
+
+  parser = subparsers.add_parser('stats', help=stats.__doc__)
+
+  from .query import Database
+
+  db = Database()
+
+  if not db.is_valid():
+    protocols = ('waiting', 'for', 'database', 'creation')
+  else:
+    protocols = [k.name for k in db.protocols()]
+
+  parser.add_argument('-x', '--protocol', dest="protocol", default=None, action='append', help="if given, limits the breakdown to this protocol; may be given multiple times (defaults to all protocols)", choices=protocols)
+  parser.add_argument('-l', '--light', dest="light", default='', help="if given, limits the breakdown to files shot under a given lighting. (defaults to '%(default)s')", choices=db.lights())
+  parser.add_argument('--self-test', dest="selftest", default=False,
+                      action='store_true', help=SUPPRESS)
+
+  parser.set_defaults(func=stats)  # action
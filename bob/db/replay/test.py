@@ -23,8 +23,10 @@
 import os
 import sys
 import unittest
-from .query import Database
+from .query import Database, QUERY_MODES
 from .models import *
+from .framecache import FrameCache
+from .faces import FaceLocationCache, FaceLocationStore, align_bbx, align_bbx_batch, crop_faces
 
 authenticate_str = 'authenticate'
 if sys.version_info[0] < 3:
@@ -233,3 +235,1226 @@ class ReplayDatabaseTest(unittest.TestCase):
   def test22_queryPrintVideoAttacks(self):
 
     self.queryAttackType(('digitalphoto', 'photo'), 600)
+
+  @db_available
+  def test23_queryModes(self):
+
+    sql = Database()
+    union = Database(mode='union')
+    index = Database(mode='index')
+
+    for query in (dict(), dict(cls='enroll'), dict(cls='real', groups='devel'),
+                  dict(cls=('real', 'attack'), protocol=('print', 'video')),
+                  dict(cls='attack', support='hand', light='adverse'),
+                  dict(clients=(3, 117), cls=('enroll', 'real', 'attack'))):
+      expected = [k.id for k in sql.objects(**query)]
+      self.assertEqual(expected, [k.id for k in union.objects(**query)])
+      self.assertEqual(expected, [k.id for k in index.objects(**query)])
+
+    self.assertRaises(RuntimeError, index.objects, protocol='foo')
+    self.assertRaises(RuntimeError, Database, mode='foo')
+
+  @db_available
+  def test24_manage_benchmark(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    self.assertEqual(main('replay benchmark --repetitions=1 --self-test'.split()), 0)
+
+  @db_available
+  def test25_vocabularyCache(self):
+
+    db = Database()
+    db.objects(cls='real')
+    vocabulary = db._vocabulary()
+    db.objects(cls='attack', clients=(3, 117), protocol='print')
+    self.assertTrue(db._vocabulary() is vocabulary)
+    self.assertEqual(set(vocabulary['clients']), set(k.id for k in db.clients()))
+    self.assertEqual(vocabulary['protocols'], set(k.name for k in db.protocols()))
+    self.assertRaises(RuntimeError, db.objects, clients=(32,))
+
+  @db_available
+  def test26_unionModeStatements(self):
+
+    from sqlalchemy import event
+
+    db = Database(mode='union')
+    db.objects(cls='enroll')  # loads the vocabulary cache
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+      statements.append(statement)
+
+    event.listen(db.m_session.bind, 'before_cursor_execute', count)
+    try:
+      f = db.objects(cls=('enroll', 'real', 'attack'))
+      self.assertEqual(len(f), 1300)
+      for k in f:
+        if k.is_real():
+          k.get_realaccess().purpose
+        else:
+          k.get_attack().attack_support
+        k.client.set
+    finally:
+      event.remove(db.m_session.bind, 'before_cursor_execute', count)
+
+    # one statement for files and clients, plus one per eager-loaded relation
+    # and per batch of 500 files (SQLAlchemy's "selectin" batch size)
+    batches = (len(f) + 499) // 500
+    self.assertTrue(len(statements) <= 1 + 2 * batches, len(statements))
+
+  @db_available
+  def test27_paths(self):
+
+    db = Database()
+    f = db.objects(cls=('enroll', 'real', 'attack'))
+    ids = [k.id for k in reversed(f)] + [f[0].id, -1]
+    paths = db.paths(ids, prefix='dir', suffix='.mov')
+    self.assertEqual(len(paths), len(f) + 1)
+    self.assertEqual(paths[:-1], [k.videofile('dir') for k in reversed(f)])
+    self.assertEqual(paths[-1], f[0].videofile('dir'))
+
+  @db_available
+  def test28_reverse(self):
+
+    db = Database()
+    f = db.objects(cls=('enroll', 'real', 'attack'))
+    stems = [k.path for k in reversed(f)] + ['does/not/exist']
+    self.assertEqual(db.reverse(stems), [k.id for k in reversed(f)])
+
+    basenames = [os.path.basename(k.path) for k in f[:10]]
+    self.assertEqual(db.reverse(basenames, match='basename'),
+                     [k.id for k in f[:10]])
+
+    hand = db.objects(cls='attack', groups='devel', support='hand')
+    for pattern in ('devel/attack/hand/*', 'devel/attack/hand/',
+                    'devel/*/hand/attack_*'):
+      self.assertEqual(set(db.reverse([pattern], match='glob')),
+                       set(k.id for k in hand))
+    self.assertEqual(db.reverse(['foo/*'], match='glob'), [])
+
+    self.assertRaises(RuntimeError, db.reverse, stems, match='foo')
+
+  @db_available
+  def test29_manage_reverse(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    self.assertEqual(main('replay reverse --match=glob devel/attack/hand/* --self-test'.split()), 0)
+
+  @db_available
+  def test30_records(self):
+
+    import pickle
+
+    query = dict(cls=('enroll', 'real', 'attack'), clients=(3, 5))
+    for mode in QUERY_MODES:
+      db = Database(mode=mode)
+      records = db.records(**query)
+      objects = db.objects(**query)
+      self.assertEqual([k.id for k in records], [k.id for k in objects])
+
+      for r, f in zip(records, objects):
+        self.assertEqual(r.path, f.path)
+        self.assertEqual(r.client_id, f.client.id)
+        self.assertEqual(r.group, f.client.set)
+        self.assertEqual(r.light, f.light)
+        self.assertEqual(r.is_real(), f.is_real())
+        self.assertEqual(r.videofile('foo'), f.videofile('foo'))
+        self.assertEqual(r.facefile('foo'), f.facefile('foo'))
+        if f.is_real():
+          self.assertEqual(r.cls, f.get_realaccess().purpose == 'enroll' and
+                           'enroll' or 'real')
+          self.assertEqual(r.take, f.get_realaccess().take)
+          self.assertTrue(r.attack_device is None)
+        else:
+          self.assertEqual(r.cls, 'attack')
+          self.assertEqual(r.sample_type, f.get_attack().sample_type)
+          self.assertEqual(r.attack_support, f.get_attack().attack_support)
+          self.assertTrue(r.purpose is None)
+
+      self.assertEqual(pickle.loads(pickle.dumps(records)), records)
+      self.assertFalse(hasattr(records[0], '__dict__'))
+
+  @db_available
+  def test31_columns(self):
+
+    import numpy
+
+    db = Database()
+    columns = db.columns()
+    files = db.objects(cls=('enroll', 'real', 'attack'))
+    self.assertEqual(len(columns['id']), len(files))
+    self.assertTrue((numpy.diff(columns['id']) > 0).all())
+    self.assertEqual(columns['protocols'],
+                     tuple(sorted(k.name for k in db.protocols())))
+
+    grandtest = columns['protocols'].index('grandtest')
+    for cls in ('real', 'attack'):
+      expected = sorted(k.id for k in db.objects(cls=cls))
+      selected = columns['membership'][:, grandtest] & \
+          (columns['is_real'] == (cls == 'real'))
+      self.assertEqual(columns['id'][selected].tolist(), expected)
+
+    expected = sorted(k.id for k in db.objects(cls='enroll', groups='devel'))
+    selected = (columns['purpose'] == 'enroll') & (columns['group'] == 'devel')
+    self.assertEqual(columns['id'][selected].tolist(), expected)
+
+    expected = sorted(k.id for k in db.objects(cls='attack', support='hand',
+                                                light='adverse', clients=3))
+    selected = (columns['attack_support'] == 'hand') & \
+        (columns['light'] == 'adverse') & (columns['client_id'] == 3)
+    self.assertEqual(columns['id'][selected].tolist(), expected)
+
+    f = db.objects(cls='attack', clients=3)[0]
+    k = columns['id'].tolist().index(f.id)
+    self.assertEqual(columns['attack_device'][k], f.get_attack().attack_device)
+    self.assertEqual(columns['purpose'][k], '')
+    self.assertEqual(columns['take'][k], -1)
+
+    array, protocols = db.columns(structured=True)
+    self.assertEqual(protocols, columns['protocols'])
+    self.assertEqual(len(array), len(files))
+    for name in columns:
+      if name != 'protocols':
+        self.assertTrue(numpy.array_equal(array[name], columns[name]))
+
+  @db_available
+  def test32_indexes(self):
+
+    import shutil
+    import sqlite3
+    import tempfile
+    import argparse
+    from .benchmark import drop_indexes
+    from .create import create_tables
+
+    def indexes(sqlite_file):
+      connection = sqlite3.connect(sqlite_file)
+      retval = set(k[0] for k in connection.execute(
+          "SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'ix_%'"))
+      connection.close()
+      return retval
+
+    expected = set(index.name for table in Base.metadata.sorted_tables
+                   for index in table.indexes)
+    self.assertTrue('ix_attacks_protocols_protocol' in expected)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+      sqlite_file = os.path.join(tmpdir, 'db.sql3')
+      shutil.copy(Database().m_sqlite_file, sqlite_file)
+      drop_indexes(sqlite_file)
+      self.assertEqual(indexes(sqlite_file), set())
+      before = [k.id for k in Database(sqlite_file=sqlite_file).objects()]
+
+      # adds missing indexes to an existing database
+      create_tables(argparse.Namespace(type='sqlite', files=[sqlite_file],
+                                       verbose=0))
+      self.assertEqual(indexes(sqlite_file), expected)
+      after = [k.id for k in Database(sqlite_file=sqlite_file).objects()]
+      self.assertEqual(before, after)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  @db_available
+  def test33_manage_benchmark_indexes(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    self.assertEqual(main('replay benchmark --compare-indexes --mode=sql --repetitions=1 --self-test'.split()), 0)
+
+  def test34_compactLayout(self):
+
+    import shutil
+    import tempfile
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+      for compact in (False, True):
+        sqlite_file = os.path.join(tmpdir, '%s.sql3' % compact)
+        engine = create_engine('sqlite:///' + sqlite_file)
+        self.assertEqual(set_compact(engine, compact), compact)
+        Base.metadata.create_all(engine)
+
+        session = sessionmaker(bind=engine)()
+        client = Client(1, 'devel')
+        session.add(client)
+        session.add(File(client, 'devel/real/foo', 'adverse'))
+        session.commit()
+        session.close()
+
+        # stored values depend on the layout...
+        with engine.connect() as connection:
+          stored = connection.execute(
+              text('SELECT "set" FROM client')).fetchall()[0][0]
+        self.assertEqual(stored, 1 if compact else 'devel')
+
+        # ... but not the values seen through the ORM, which is detected
+        engine = create_engine('sqlite:///' + sqlite_file)
+        self.assertEqual(set_compact(engine), compact)
+        session = sessionmaker(bind=engine)()
+        f = session.query(File).join(Client).filter(
+            Client.set.in_(('devel', 'test')), File.light == 'adverse').one()
+        self.assertEqual((f.client.set, f.light), ('devel', 'adverse'))
+        self.assertEqual(session.query(File).filter(
+            File.light == 'controlled').count(), 0)
+        session.close()
+
+        # the layout must be set, and cannot change
+        self.assertEqual(set_compact(engine, compact), compact)
+        self.assertRaises(RuntimeError, set_compact, engine, not compact)
+        session = sessionmaker(bind=create_engine('sqlite:///' + sqlite_file))()
+        self.assertRaises(RuntimeError, session.query(File).filter(
+            File.light == 'adverse').count)
+        session.close()
+    finally:
+      shutil.rmtree(tmpdir)
+
+  @db_available
+  def test35_attackFilters(self):
+
+    everything = set(k.id for k in
+                     Database().objects(cls=('enroll', 'real', 'attack')))
+
+    for query in (dict(device='mobile'), dict(sample_type='photo'),
+                  dict(sample_device=('highdef',), groups='devel'),
+                  dict(support='hand', device='mobile', sample_type='video',
+                       light='adverse'),
+                  dict(device=('print', 'highdef'), protocol='grandtest',
+                       cls=('real', 'attack'))):
+      attributes = ('device', 'sample_type', 'sample_device')
+
+      def matches(f):
+        if not f.attack:
+          return True
+        for name in attributes:
+          if name in query:
+            values = query[name]
+            if not isinstance(values, tuple):
+              values = (values,)
+            value = getattr(f.get_attack(),
+                            'attack_' + name if name == 'device' else name)
+            if value not in values:
+              return False
+        return True
+
+      unfiltered = dict((k, v) for k, v in query.items()
+                        if k not in attributes)
+      for mode in QUERY_MODES:
+        db = Database(mode=mode)
+        expected = [k.id for k in db.objects(**unfiltered) if matches(k)]
+        self.assertEqual([k.id for k in db.objects(**query)], expected)
+        self.assertEqual([k.id for k in db.records(**query)], expected)
+        self.assertTrue(0 < len(expected) < len(everything))
+        self.assertTrue(set(expected) <= everything)
+
+    db = Database()
+    self.assertTrue(len(db.objects(cls='attack', device='mobile')) > 0)
+    self.assertEqual(db.objects(cls='real', device='mobile'),
+                     db.objects(cls='real'))
+    self.assertRaises(RuntimeError, db.objects, device='foo')
+    self.assertRaises(RuntimeError, db.objects, sample_type='foo')
+
+  @db_available
+  def test36_manage_attackFilters(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    self.assertEqual(main('replay dumplist --class=attack --device=mobile --sample-type=video --sample-device=highdef --self-test'.split()), 0)
+    self.assertEqual(main('replay checkfiles --class=attack --device=print --self-test'.split()), 0)
+
+  @db_available
+  def test37_countFacets(self):
+
+    queries = (dict(), dict(cls='enroll'), dict(groups='devel', light='adverse'),
+               dict(cls=('real', 'attack'), protocol=('print', 'video')),
+               dict(cls='attack', support='hand', device='mobile'),
+               dict(cls=('enroll', 'real', 'attack'), clients=(3, 117)))
+
+    for mode in QUERY_MODES:
+      db = Database(mode=mode)
+      for query in queries:
+        self.assertEqual(db.count(**query), len(db.objects(**query)))
+
+    db = Database()
+    for query in queries:
+      files = db.objects(**query)
+      self.assertEqual(sum(db.facets('group', **query).values()), len(files))
+
+      expected = {}
+      for f in files:
+        if f.attack:
+          key = ('attack', f.client.set, f.get_attack().attack_support)
+        else:
+          key = (f.get_realaccess().purpose == 'enroll' and 'enroll' or 'real',
+                 f.client.set, None)
+        expected[key] = expected.get(key, 0) + 1
+      self.assertEqual(db.facets(('cls', 'group', 'support'), **query),
+                       expected)
+
+    # files are counted once per protocol
+    counts = db.facets('protocol', protocol=('print', 'grandtest'),
+                       cls=('enroll', 'real', 'attack'))
+    self.assertEqual(counts, {
+        None: db.count(cls='enroll'),
+        'print': db.count(protocol='print'),
+        'grandtest': db.count(protocol='grandtest'),
+    })
+    self.assertRaises(RuntimeError, db.facets, 'foo')
+
+  @db_available
+  def test38_manage_stats(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    self.assertEqual(main('replay stats --self-test'.split()), 0)
+    self.assertEqual(main('replay stats --protocol=print --light=adverse --self-test'.split()), 0)
+
+  @db_available
+  def test39_iterObjects(self):
+
+    from sqlalchemy import event
+
+    for mode in QUERY_MODES:
+      db = Database(mode=mode)
+      for query in (dict(), dict(cls=('enroll', 'real', 'attack')),
+                    dict(cls=('real', 'attack'), protocol=('print', 'video')),
+                    dict(cls='attack', device='mobile', groups='test')):
+        expected = [k.id for k in db.objects(**query)]
+        for batch_size in (1, 7, 1000):
+          self.assertEqual([k.id for k in db.iter_objects(batch_size=batch_size,
+                                                          **query)], expected)
+
+    # rows are fetched in batches, the first ones before the others
+    db = Database()
+    expected = db.objects()[0].id  # also loads the vocabulary
+    statements = []
+
+    def count(*args):
+      statements.append(args[2])
+
+    engine = db.m_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+      iterator = db.iter_objects(batch_size=10)
+      first = next(iterator)
+      self.assertEqual(len(statements), 1)
+      self.assertEqual(first.id, expected)
+      iterator.close()
+    finally:
+      event.remove(engine, 'before_cursor_execute', count)
+
+    self.assertRaises(RuntimeError, db.iter_objects, batch_size=0)
+    self.assertRaises(RuntimeError, db.iter_objects, device='foo')
+
+  @db_available
+  def test40_memoize(self):
+
+    import shutil
+    import tempfile
+
+    for mode in QUERY_MODES:
+      plain = Database(mode=mode)
+      db = Database(mode=mode, memoize=2)
+      self.assertEqual(db.memo_info(),
+                       dict(hits=0, misses=0, size=0, max_size=2))
+
+      expected = [k.id for k in plain.objects(groups='devel')]
+      self.assertEqual([k.id for k in db.objects(groups='devel')], expected)
+      self.assertEqual([k.id for k in db.objects(groups=('devel',))], expected)
+      self.assertEqual(db.count(groups=['devel', 'devel']), len(expected))
+      self.assertEqual(db.memo_info()['hits'], 2)
+      self.assertEqual(db.memo_info()['misses'], 1)
+
+      # order-insensitive, and "all values" is the same as no filter
+      query = dict(cls=('real', 'attack'), protocol=('print', 'video'))
+      expected = [k.id for k in plain.objects(**query)]
+      self.assertEqual([k.id for k in db.objects(**query)], expected)
+      self.assertEqual([k.id for k in db.records(
+          cls=('attack', 'real'), protocol=('video', 'print'),
+          support=('hand', 'fixed'), light=None)], expected)
+      self.assertEqual(db.memo_info(),
+                       dict(hits=3, misses=2, size=2, max_size=2))
+
+      # least recently used queries are evicted
+      db.objects(cls='enroll')
+      self.assertEqual(db.memo_info()['size'], 2)
+      db.objects(groups='devel')
+      self.assertEqual(db.memo_info()['misses'], 4)
+
+      db.clear_memo()
+      self.assertEqual(db.memo_info(),
+                       dict(hits=0, misses=0, size=0, max_size=2))
+
+    # memo hits in 'union' mode load relationships eagerly, too
+    from sqlalchemy import event
+    db = Database(mode='union', memoize=2)
+    expected = [k.id for k in db.objects(cls=('real', 'attack'))]
+    db.m_session.expunge_all()
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+      statements.append(statement)
+
+    event.listen(db.m_session.bind, 'before_cursor_execute', count)
+    try:
+      f = db.objects(cls=('real', 'attack'))
+      for k in f:
+        if k.is_real():
+          k.get_realaccess().purpose
+        else:
+          k.get_attack().attack_support
+        k.client.set
+    finally:
+      event.remove(db.m_session.bind, 'before_cursor_execute', count)
+    self.assertEqual([k.id for k in f], expected)
+    self.assertEqual(db.memo_info()['hits'], 1)
+    batches = (len(f) + 499) // 500
+    self.assertTrue(len(statements) <= 4 * batches, len(statements))
+
+    # memoized results are discarded if the database changes
+    tmpdir = tempfile.mkdtemp()
+    try:
+      sqlite_file = os.path.join(tmpdir, 'db.sql3')
+      shutil.copy(Database().m_sqlite_file, sqlite_file)
+      db = Database(sqlite_file=sqlite_file, memoize=10)
+      self.assertEqual(len(db.objects(clients=3)), db.count(clients=3))
+      self.assertEqual(db.memo_info()['size'], 1)
+      stat = os.stat(sqlite_file)
+      os.utime(sqlite_file, (stat.st_atime, stat.st_mtime + 10))
+      db.objects(clients=3)
+      self.assertEqual(db.memo_info()['size'], 1)
+      self.assertEqual(db.memo_info()['misses'], 2)
+      db.m_session.close()
+    finally:
+      shutil.rmtree(tmpdir)
+
+
+def write_face_files(files, directory):
+  """Writes synthetic face location files for the given files"""
+
+  import numpy
+  retval = {}
+  for k, f in enumerate(files):
+    bbx = numpy.array([(i, k, 2 * k, 10 + i, 20 + i) for i in range(0, 10 + k, 2)])
+    filename = f.facefile(directory)
+    if not os.path.exists(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    numpy.savetxt(filename, bbx, fmt='%d')
+    retval[f.id] = bbx
+  return retval
+
+
+class FaceLocationTest(unittest.TestCase):
+  """Tests fast access to face locations"""
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  @db_available
+  def test01_cache(self):
+
+    import numpy
+    db = Database()
+    f = db.objects(clients=(3,))[:3]
+    bbx = write_face_files(f, self.directory)
+    cache = os.path.join(self.directory, 'cache')
+
+    for k in f:
+      self.assertTrue(numpy.array_equal(k.bbx(self.directory), bbx[k.id]))
+      cached = k.bbx(self.directory, cache=cache)
+      self.assertTrue(isinstance(cached, numpy.memmap))
+      self.assertEqual(cached.dtype, numpy.int32)
+      self.assertTrue(numpy.array_equal(cached, bbx[k.id]))
+
+    # cached files get the default permissions, not the private ones of
+    # temporary files
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = os.stat(FaceLocationCache(cache).filename(f[0])).st_mode
+    self.assertEqual(mode & 0o777, 0o666 & ~umask)
+
+    # updates the cache if the face file changes
+    numpy.savetxt(f[0].facefile(self.directory), bbx[f[0].id][:2], fmt='%d')
+    t = os.path.getmtime(f[0].facefile(self.directory))
+    os.utime(FaceLocationCache(cache).filename(f[0]), (t - 10, t - 10))
+    self.assertEqual(len(f[0].bbx(self.directory, cache=cache)), 2)
+
+  @db_available
+  def test02_manage_facecache(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    db = Database()
+    write_face_files(db.objects(clients=(3,)), self.directory)
+    cache = os.path.join(self.directory, 'cache')
+    self.assertEqual(main(('replay facecache --client=3 --self-test -d %s -o %s' % (self.directory, cache)).split()), 0)
+    self.assertEqual(main(('replay facecache --client=5 --self-test -d %s -o %s' % (self.directory, cache)).split()), 1)
+
+    # malformed face files are reported, not raised
+    with open(db.objects(clients=(3,))[0].facefile(self.directory), 'wt') as f:
+      f.write('0 1 2\n')
+    cache = os.path.join(self.directory, 'cache2')
+    self.assertEqual(main(('replay facecache --client=3 --self-test -d %s -o %s' % (self.directory, cache)).split()), 1)
+    store = os.path.join(self.directory, 'store')
+    self.assertEqual(main(('replay facecache --client=3 --self-test -d %s -S %s' % (self.directory, store)).split()), 1)
+
+  @db_available
+  def test03_store(self):
+
+    import numpy
+    db = Database()
+    f = db.objects(clients=(3,))
+    bbx = write_face_files(f, self.directory)
+    path = os.path.join(self.directory, 'store')
+
+    store = FaceLocationStore.build(f, self.directory, path)
+    self.assertEqual(len(store), len(f))
+    self.assertEqual(len(store.locations), sum(len(k) for k in bbx.values()))
+
+    store = FaceLocationStore(path)
+    for k, b in zip(f, store.batch(f)):
+      self.assertTrue(numpy.array_equal(b, bbx[k.id]))
+      self.assertTrue(numpy.array_equal(k.bbx(store=store), bbx[k.id]))
+      self.assertTrue(numpy.array_equal(k.bbx(store=path), bbx[k.id]))
+    self.assertFalse(-1 in store)
+    self.assertRaises(KeyError, store.__getitem__, -1)
+
+    # locations and offsets of different builds are never paired
+    locations = os.path.join(path, 'locations.npy')
+    os.rename(locations, locations + '.old')
+    second = FaceLocationStore.build(f[:2], self.directory, path)
+    self.assertNotEqual(second.generation, store.generation)
+    os.rename(locations + '.old', locations)
+    self.assertRaises(RuntimeError, FaceLocationStore, path, retries=0)
+    self.assertEqual(len(FaceLocationStore.build(f, self.directory, path)), len(f))
+
+  @db_available
+  def test04_manage_facestore(self):
+
+    from bob.db.base.script.dbmanage import main
+
+    db = Database()
+    write_face_files(db.objects(clients=(3,)), self.directory)
+    store = os.path.join(self.directory, 'store')
+    self.assertEqual(main(('replay facecache --client=3 --self-test -d %s -S %s' % (self.directory, store)).split()), 0)
+    self.assertEqual(len(FaceLocationStore(store)), len(db.objects(clients=(3,))))
+    self.assertEqual(main(('replay facecache --client=3 --self-test -d %s' % (self.directory,)).split()), 1)
+
+  def test05_align(self):
+
+    import numpy
+    bbx = numpy.array([(1, 10, 20, 30, 40), (3, 14, 24, 34, 44),
+                       (4, 0, 0, 0, 0)])
+
+    boxes, detected = align_bbx(bbx, 6)
+    self.assertEqual(detected.tolist(), [False, True, False, True, False, False])
+    self.assertEqual(boxes[0].tolist(), [0, 0, 0, 0])
+    self.assertEqual(boxes[3].tolist(), [14, 24, 34, 44])
+
+    boxes, detected = align_bbx(bbx, 6, fill='ffill')
+    self.assertEqual(boxes[:, 0].tolist(), [10, 10, 10, 14, 14, 14])
+
+    boxes, detected = align_bbx(bbx, 6, fill='linear')
+    self.assertEqual(boxes[:, 0].tolist(), [10, 10, 12, 14, 14, 14])
+    self.assertEqual(boxes[2].tolist(), [12, 22, 32, 42])
+
+    out, detected = align_bbx_batch([bbx, bbx[:1], bbx[:0]], 5, fill='ffill')
+    self.assertEqual(out.shape, (3, 5, 4))
+    self.assertEqual(detected.sum(axis=1).tolist(), [2, 1, 0])
+    self.assertEqual(out[1, :, 0].tolist(), [10] * 5)
+    self.assertEqual(out[2].sum(), 0)
+
+    self.assertRaises(RuntimeError, align_bbx, bbx, 6, fill='foo')
+
+  @db_available
+  def test06_dense_bbx(self):
+
+    db = Database()
+    f = db.objects(clients=(3,))[1]
+    write_face_files([f], self.directory)  # faces on even frames only
+    boxes, detected = f.dense_bbx(self.directory, n_frames=12, fill='linear')
+    self.assertEqual(detected.tolist(), [True, False] * 5 + [False, False])
+    self.assertEqual(boxes[:, 2].tolist(), list(range(10, 19)) + [18] * 3)
+
+  def test07_crop(self):
+
+    import numpy
+    frames = numpy.zeros((2, 3, 40, 60), dtype=numpy.uint8)
+    frames[0, 0, 10:20, 30:50] = 200  # red rectangle
+    frames[1, 2] = numpy.arange(60)  # blue horizontal ramp
+    boxes = numpy.array([(30, 10, 20, 10), (0, 0, 60, 40)])
+
+    crops = crop_faces(frames, boxes, 8)
+    self.assertEqual(crops.shape, (2, 3, 8, 8))
+    self.assertEqual(crops.dtype, numpy.uint8)
+    self.assertTrue((crops[0, 0] == 200).all())
+    self.assertTrue((crops[0, 1:] == 0).all())
+    self.assertTrue((numpy.diff(crops[1, 2].astype(int), axis=1) > 0).all())
+    self.assertTrue((crops[1, 2] == crops[1, 2, :1]).all())
+
+    gray = crop_faces(frames, boxes, 8, gray=True)
+    self.assertEqual(gray.shape, (2, 8, 8))
+    self.assertTrue((gray[0] == round(0.299 * 200)).all())
+
+    self.assertRaises(RuntimeError, crop_faces, frames, boxes, 8,
+                      out=numpy.empty((2, 8, 8), dtype=numpy.uint8))
+
+
+class FrameCacheTest(unittest.TestCase):
+  """Tests the disk-backed cache of decoded frames"""
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  @db_available
+  def test01_put_get(self):
+
+    import numpy
+    f = Database().objects(clients=(3,))[:2]
+    cache = FrameCache(self.directory)
+    data = numpy.arange(3 * 4 * 5, dtype=numpy.uint8).reshape(3, 4, 5)
+
+    self.assertTrue(cache.get(f[0]) is None)
+    cache.put(f[0], data, extension='.mov')
+    self.assertTrue(numpy.array_equal(cache.get(f[0], extension='.mov'), data))
+    self.assertTrue(cache.get(f[1], extension='.mov') is None)
+
+    # options are normalized, and unset ones ignored
+    cache.put(f[0], data[::2], extension='.mov', frames=slice(None, None, 2))
+    self.assertTrue(numpy.array_equal(cache.get(f[0], extension='.mov',
+                                                frames=slice(None, None, 2),
+                                                nframes=None), data[::2]))
+    cache.put(f[1], data[[0, 2]], frames=numpy.array([0, 2]))
+    self.assertTrue(numpy.array_equal(cache.get(f[1], frames=[0, 2]),
+                                      data[[0, 2]]))
+
+  @db_available
+  def test02_evict(self):
+
+    import numpy
+    f = Database().objects(clients=(3,))[:3]
+    data = numpy.zeros((100, 100), dtype=numpy.uint8)
+    cache = FrameCache(self.directory, max_bytes=25000)
+
+    for k in f:
+      cache.put(k, data)
+      self.assertFalse(cache.get(f[0]) is None)  # keeps f[0] recently used
+      t = os.path.getmtime(cache.filename(cache.key(f[0])))
+      os.utime(cache.filename(cache.key(k)), (t - 1, t - 1))
+
+    self.assertEqual(len(cache.entries()), 2)
+    self.assertFalse(cache.get(f[0]) is None)
+    self.assertTrue(cache.size() <= 25000)
+    cache.clear()
+    self.assertEqual(cache.size(), 0)
+
+  @db_available
+  def test03_load(self):
+
+    import numpy
+    import bob.io.base
+
+    f = Database().objects(clients=(3,))[0]
+    directories = []
+    for k in range(2):
+      directory = os.path.join(self.directory, 'data%d' % k)
+      filename = f.make_path(directory, '.hdf5')
+      os.makedirs(os.path.dirname(filename))
+      bob.io.base.save(numpy.full((4, 2), k, dtype=numpy.int64), filename)
+      directories.append(directory)
+
+    cache = FrameCache(os.path.join(self.directory, 'cache'))
+    for repetition in range(2):  # second time, from the cache
+      for k, directory in enumerate(directories):
+        self.assertTrue((f.load(directory, '.hdf5', frame_cache=cache) ==
+                         k).all())
+        self.assertTrue((f.load(directory, '.hdf5', nframes=2,
+                                frame_cache=cache) == k).all())
+        self.assertTrue((numpy.array(list(f.frames(
+            directory, '.hdf5', frame_cache=cache.directory))) == k).all())
+    self.assertTrue(isinstance(f.load(directories[0], '.hdf5',
+                                      frame_cache=cache), numpy.memmap))
+
+    # replaced files are decoded again
+    filename = f.make_path(directories[0], '.hdf5')
+    bob.io.base.save(numpy.full((5, 2), 7, dtype=numpy.int64), filename)
+    self.assertTrue((f.load(directories[0], '.hdf5', frame_cache=cache) ==
+                     7).all())
+    self.assertEqual(len(f.load(directories[0], '.hdf5', frame_cache=cache)),
+                     5)
+
+    # callers not asking for the cache are not affected by it
+    data = f.load(directories[0], '.hdf5')
+    self.assertFalse(isinstance(data, numpy.memmap))
+    self.assertTrue(data.flags.writeable)
+
+    # workers consult the cache they are given
+    results = list(Database().load_batch([f], directory=directories[1],
+                                         extension='.hdf5', workers=2,
+                                         frame_cache=cache))
+    self.assertTrue(isinstance(results[0].data, numpy.memmap))
+
+
+class LoadBatchTest(unittest.TestCase):
+  """Tests the parallel loading of many files"""
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  def write_files(self, files):
+    import numpy
+    import bob.io.base
+    for k in files:
+      filename = k.make_path(self.directory, '.hdf5')
+      if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+      bob.io.base.save(numpy.full((4, 2), k.id, dtype=numpy.int64), filename)
+
+  @db_available
+  def test01_load_batch(self):
+
+    db = Database()
+    files = db.objects(clients=(3,))
+    self.write_files(files[1:])
+
+    for workers in (0, 2):
+      results = list(db.load_batch(files, directory=self.directory,
+                                   extension='.hdf5', workers=workers))
+      self.assertEqual([k.file for k in results], files)
+      self.assertFalse(results[0].ok)
+      self.assertTrue(results[0].data is None)
+      self.assertTrue(isinstance(results[0].error, (IOError, OSError)))
+      for k in results[1:]:
+        self.assertTrue(k.ok)
+        self.assertEqual(k.data[0, 0], k.file.id)
+
+    # completion order
+    results = list(db.load_batch(files, directory=self.directory,
+                                 extension='.hdf5', workers=2, ordered=False))
+    self.assertEqual(sorted(k.file.id for k in results),
+                     sorted(k.id for k in files))
+    self.assertEqual(sum(not k.ok for k in results), 1)
+
+    # from a query
+    results = list(db.load_batch(directory=self.directory, extension='.hdf5',
+                                 workers=2, clients=3, cls='enroll'))
+    self.assertEqual([k.file for k in results],
+                     db.objects(clients=3, cls='enroll'))
+    self.assertRaises(RuntimeError, lambda: db.load_batch(files, clients=3))
+
+  @db_available
+  def test02_prefetch(self):
+
+    db = Database()
+    files = db.objects(clients=(3,))
+    self.write_files(files)
+
+    for backend in ('thread', 'process'):
+      p = db.prefetch(files, directory=self.directory, extension='.hdf5',
+                      depth=2, workers=2, backend=backend)
+      items = list(p)
+      self.assertEqual([k[0] for k in items], files)
+      for f, data in items:
+        self.assertEqual(data[0, 0], f.id)
+      stats = p.statistics()
+      self.assertEqual(stats['items'], len(files))
+      self.assertTrue(0 <= stats['mean_depth'] <= 2)
+      self.assertTrue(stats['wait_time'] >= stats['max_wait'] >= 0)
+
+    # chunks of frames
+    p = db.prefetch(files[:3], directory=self.directory, extension='.hdf5',
+                    chunk=3)
+    self.assertEqual([(f, start, len(data)) for f, start, data in p],
+                     [(f, k, n) for f in files[:3] for k, n in ((0, 3), (3, 1))])
+
+    # deterministic shuffling
+    p = db.prefetch(files, directory=self.directory, extension='.hdf5',
+                    shuffle=True, seed=3)
+    first = [k[0] for k in p]
+    second = [k[0] for k in p]
+    self.assertNotEqual(first, second)
+    self.assertEqual(sorted(first, key=files.index), files)
+    p.set_epoch(0)
+    self.assertEqual([k[0] for k in p], first)
+    self.assertEqual(first, db.prefetch(files, shuffle=True, seed=3).order(0))
+
+    # errors are raised or skipped, and stopping early is fine
+    os.unlink(files[1].make_path(self.directory, '.hdf5'))
+    p = db.prefetch(files, directory=self.directory, extension='.hdf5')
+    self.assertRaises((IOError, OSError), list, p)
+    p = db.prefetch(files, directory=self.directory, extension='.hdf5',
+                    skip_errors=True)
+    self.assertEqual(len(list(p)), len(files) - 1)
+    self.assertEqual(p.statistics()['skipped'], 1)
+    for k in p:
+      break
+
+
+def write_protodir(directory):
+  """Writes a tiny protocol directory, with four clients and three attack
+  protocols, in the layout of the original one"""
+
+  groups = (('train', (1, 2)), ('devel', (3,)), ('test', (4,)))
+  kinds = (('print', 'highdef', 'photo'), ('mobile', 'mobile', 'video'),
+           ('highdef', 'highdef', 'video'))
+  protocols = {'grandtest': kinds, 'print': kinds[:1], 'video': kinds[1:]}
+
+  def write(name, lines):
+    with open(os.path.join(directory, name), 'wt') as f:
+      f.write(''.join('%s\n' % k for k in lines))
+
+  write('clients.txt', ['%d %s' % (c, g) for g, clients in groups for c in clients])
+  for grp, clients in groups:
+    real = []
+    enroll = []
+    attacks = dict((k, []) for k in protocols)
+    for c in clients:
+      for light in ('controlled', 'adverse'):
+        enroll.append('enroll/%s/client%03d_session01_webcam_enroll_%s.mov' % (grp, c, light))
+        for take in (1, 2):
+          real.append('%s/real/client%03d_session01_webcam_authenticate_%s_%d.mov' % (grp, c, light, take))
+        for support in ('fixed', 'hand'):
+          for protocol, selected in protocols.items():
+            for k in selected:
+              attacks[protocol].append('%s/attack/%s/attack_%s_client%03d_session01_%s_%s_%s.mov' % (grp, support, k[0], c, k[1], k[2], light))
+    write('real-%s.txt' % grp, real)
+    write('recognition-%s.txt' % grp, enroll)
+    for protocol, files in attacks.items():
+      write('attack-%s-allsupports-%s.txt' % (protocol, grp), files)
+
+
+class CreateTest(unittest.TestCase):
+  """Tests the creation of the database from its file lists"""
+
+  tables = ('client', 'file', 'realaccess', 'attack', 'protocol',
+            'attacks_protocols', 'realaccesses_protocols')
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+    self.protodir = os.path.join(self.directory, 'protocols')
+    os.makedirs(self.protodir)
+    write_protodir(self.protodir)
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  def create(self, dbfile, *options):
+    import argparse
+    from .create import add_command
+    parser = argparse.ArgumentParser()
+    add_command(parser.add_subparsers())
+    args = parser.parse_args(('create', '-D', self.protodir) + options)
+    args.type = 'sqlite'
+    args.files = [dbfile]
+    return args.func(args)
+
+  def rows(self, dbfile, tables=None):
+    import sqlite3
+    connection = sqlite3.connect(dbfile)
+    try:
+      return dict((k, sorted(connection.execute('SELECT * FROM %s' % k)))
+                  for k in (tables or self.tables))
+    finally:
+      connection.close()
+
+  def test01_bulk(self):
+
+    orm = os.path.join(self.directory, 'orm.sql3')
+    bulk = os.path.join(self.directory, 'bulk.sql3')
+    self.assertEqual(self.create(orm), 0)
+    self.assertEqual(self.create(bulk, '--bulk'), 0)
+
+    rows = self.rows(orm)
+    self.assertEqual(len(rows['client']), 4)
+    self.assertEqual(len(rows['file']), 4 * (2 + 4 + 2 * 2 * 3))
+    self.assertEqual(len(rows['realaccess']), 4 * (2 + 4))
+    self.assertEqual(len(rows['attack']), 4 * 2 * 2 * 3)
+    self.assertEqual(rows, self.rows(bulk))
+
+  def test02_protocols(self):
+
+    # files listed twice are associated once
+    listed = os.path.join(self.protodir, 'attack-print-allsupports-train.txt')
+    with open(listed, 'rt') as f:
+      first = f.readline()
+    with open(listed, 'at') as f:
+      f.write(first)
+
+    dbfile = os.path.join(self.directory, 'db.sql3')
+    self.assertEqual(self.create(dbfile), 0)
+    db = Database(sqlite_file=dbfile)
+    for protocol, attacks in (('grandtest', 48), ('print', 16), ('video', 32)):
+      self.assertEqual(len(db.objects(protocol=protocol, cls='attack')), attacks)
+      self.assertEqual(len(db.objects(protocol=protocol, cls='real')), 16)
+    rows = self.rows(dbfile, ('attacks_protocols', 'realaccesses_protocols'))
+    self.assertEqual(len(rows['attacks_protocols']), 48 + 16 + 32)
+    self.assertEqual(len(rows['realaccesses_protocols']), 3 * 16)
+
+    # files missing from the database are not silently dropped
+    with open(listed, 'at') as f:
+      f.write('train/attack/fixed/attack_print_client001_session01_highdef_photo_unknown.mov\n')
+    for options in ((), ('--bulk',)):
+      try:
+        self.create(dbfile, '--recreate', *options)
+        self.fail('files missing from the database were ignored')
+      except RuntimeError as e:
+        self.assertTrue('attack_print_client001_session01_highdef_photo_unknown' in str(e))
+
+  def test03_incremental(self):
+
+    import sqlite3
+    dbfile = os.path.join(self.directory, 'db.sql3')
+    self.assertEqual(self.create(dbfile), 0)
+    before = self.rows(dbfile, self.tables + ('listfile',))
+    protocols = dict((name, id) for id, name in before['protocol'])
+
+    # only the associations and the digest of the changed list are updated
+    listed = os.path.join(self.protodir, 'attack-print-allsupports-devel.txt')
+    with open(listed, 'rt') as f:
+      lines = f.readlines()
+    with open(listed, 'wt') as f:
+      f.writelines(lines[1:])
+    self.assertEqual(self.create(dbfile, '--incremental'), 0)
+    after = self.rows(dbfile, self.tables + ('listfile',))
+
+    for table in self.tables[:-2]:
+      self.assertEqual(after[table], before[table])
+    self.assertEqual(after['realaccesses_protocols'],
+                     before['realaccesses_protocols'])
+    removed = set(before['attacks_protocols']) - set(after['attacks_protocols'])
+    self.assertEqual(len(removed), 1)
+    self.assertEqual(list(removed)[0][1], protocols['print'])
+    self.assertTrue(set(after['attacks_protocols']) < set(before['attacks_protocols']))
+    digests = dict(k[1:] for k in before['listfile'])
+    updated = dict(k[1:] for k in after['listfile'])
+    self.assertEqual(sorted(updated), sorted(digests))
+    self.assertEqual([k for k in digests if digests[k] != updated[k]],
+                     [os.path.basename(listed)])
+
+    # databases without list digests are re-created
+    connection = sqlite3.connect(dbfile)
+    connection.execute("INSERT INTO protocol (name) VALUES ('stale')")
+    connection.execute('DROP TABLE listfile')
+    connection.commit()
+    connection.close()
+    self.assertEqual(self.create(dbfile, '--incremental'), 0)
+    recreated = self.rows(dbfile, self.tables + ('listfile',))
+    self.assertFalse('stale' in [k[1] for k in recreated['protocol']])
+    self.assertEqual(dict(k[1:] for k in recreated['listfile']), updated)
+    self.assertEqual(len(recreated['attacks_protocols']),
+                     len(after['attacks_protocols']))
+
+  def test04_layout(self):
+
+    import sqlite3
+
+    def compact(dbfile):
+      connection = sqlite3.connect(dbfile)
+      try:
+        columns = connection.execute('PRAGMA table_info(client)').fetchall()
+      finally:
+        connection.close()
+      return 'INT' in dict((k[1], k[2].upper()) for k in columns)['set']
+
+    def drop_digests(dbfile):
+      connection = sqlite3.connect(dbfile)
+      connection.execute('DROP TABLE listfile')
+      connection.commit()
+      connection.close()
+
+    dbfile = os.path.join(self.directory, 'db.sql3')
+    self.assertEqual(self.create(dbfile, '--compact'), 0)
+    self.assertTrue(compact(dbfile))
+
+    # incremental updates and their fallback keep the layout
+    self.assertEqual(self.create(dbfile, '--incremental'), 0)
+    self.assertTrue(compact(dbfile))
+    drop_digests(dbfile)
+    self.assertEqual(self.create(dbfile, '--incremental'), 0)
+    self.assertTrue(compact(dbfile))
+    drop_digests(dbfile)
+    self.assertEqual(self.create(dbfile, '--incremental', '--compact'), 0)
+    self.assertTrue(compact(dbfile))
+
+    # the layout can only be changed by a re-creation
+    self.assertEqual(self.create(dbfile, '--recreate'), 0)
+    self.assertFalse(compact(dbfile))
+    before = self.rows(dbfile)
+    drop_digests(dbfile)
+    self.assertEqual(self.create(dbfile, '--incremental', '--compact'), 1)
+    self.assertFalse(compact(dbfile))
+    self.assertEqual(self.rows(dbfile), before)
+    self.assertEqual(self.create(dbfile, '--recreate', '--incremental',
+                                 '--compact'), 0)
+    self.assertTrue(compact(dbfile))
+
+
+class ShortVideoReader(object):
+  """A video reader whose stream ends before the number of frames it
+  announces, as happens with truncated files"""
+
+  def __init__(self, filename):
+    self.height = 4
+    self.width = 5
+
+  def __len__(self):
+    return 10
+
+  def __iter__(self):
+    import numpy
+    for k in range(7):
+      yield numpy.full((3, self.height, self.width), k, dtype=numpy.uint8)
+
+
+class VideoTest(unittest.TestCase):
+  """Tests the memory-conscious access to videos"""
+
+  def setUp(self):
+    import bob.io.video
+    self.reader = bob.io.video.reader
+
+  def tearDown(self):
+    import bob.io.video
+    bob.io.video.reader = self.reader
+
+  def test01_truncated(self):
+
+    import bob.io.video
+    from .video import load_frames
+    bob.io.video.reader = ShortVideoReader
+
+    data = load_frames('truncated.mov')
+    self.assertEqual(data.shape, (7, 3, 4, 5))
+    self.assertEqual(data[:, 0, 0, 0].tolist(), list(range(7)))
+    data = load_frames('truncated.mov', frames=[8, 5, 1, 9, 5])
+    self.assertEqual(data[:, 0, 0, 0].tolist(), [5, 1, 5])
+    self.assertEqual(load_frames('truncated.mov', frames=[8, 9]).shape,
+                     (0, 3, 4, 5))
+
+  @db_available
+  def test02_faces(self):
+
+    import tempfile
+    import shutil
+    import bob.io.video
+
+    opened = []
+
+    class Reader(ShortVideoReader):
+      def __init__(self, filename):
+        opened.append(filename)
+        ShortVideoReader.__init__(self, filename)
+
+    bob.io.video.reader = Reader
+
+    f = Database().objects(clients=(3,))[0]
+    directory = tempfile.mkdtemp()
+    try:
+      filename = f.facefile(directory)
+      os.makedirs(os.path.dirname(filename))
+      with open(filename, 'wt') as out:
+        out.write('0 1 1 3 2\n')
+
+      # frames missing from a truncated video are left out
+      indices, crops = f.load_faces(directory, size=2, chunk=3,
+                                    with_index=True)
+      self.assertEqual(indices.tolist(), list(range(7)))
+      self.assertEqual(crops.shape, (7, 3, 2, 2))
+      self.assertEqual(crops[:, 0, 0, 0].tolist(), list(range(7)))
+      self.assertEqual(len(opened), 1)
+
+      # crops follow the order of the selection
+      indices, crops = f.load_faces(directory, size=2, frames=[8, 5, 1, 9, 5],
+                                    with_index=True)
+      self.assertEqual(indices.tolist(), [5, 1, 5])
+      self.assertEqual(crops[:, 0, 0, 0].tolist(), [5, 1, 5])
+      crops = f.load_faces(directory, size=2, gray=True, frames=[6, 0],
+                           chunk=None)
+      self.assertEqual(crops[:, 0, 0].tolist(), [6, 0])
+      self.assertEqual(len(opened), 3)
+    finally:
+      shutil.rmtree(directory)
+
+  def test03_chunks(self):
+
+    import numpy
+    from .video import iter_array, _chunked
+    data = numpy.arange(7 * 2).reshape(7, 2)
+
+    # frame by frame
+    self.assertEqual([k.tolist() for k in iter_array(data)], data.tolist())
+    self.assertEqual([(i, k.tolist()) for i, k in
+                      iter_array(data, with_index=True)],
+                     list(enumerate(data.tolist())))
+
+    # chunks, the last one being partial
+    chunks = list(iter_array(data, chunk=3, with_index=True))
+    self.assertEqual([i for i, k in chunks], [0, 3, 6])
+    self.assertEqual([len(k) for i, k in chunks], [3, 3, 1])
+    self.assertEqual(numpy.vstack([k for i, k in chunks]).tolist(),
+                     data.tolist())
+    self.assertEqual([len(k) for k in iter_array(data[:6], chunk=3)], [3, 3])
+
+    # chunks of a selection start at their first selected frame
+    chunks = list(iter_array(data, chunk=2, with_index=True, frames=[5, 1, 3]))
+    self.assertEqual([(i, k.tolist()) for i, k in chunks],
+                     [(1, data[[1, 3]].tolist()), (5, data[[5]].tolist())])
+
+    # streamed chunks are independent arrays
+    chunks = list(_chunked(enumerate(data), 3, True))
+    self.assertEqual([i for i, k in chunks], [0, 3, 6])
+    self.assertEqual([k.tolist() for i, k in chunks],
+                     [data[:3].tolist(), data[3:6].tolist(), data[6:].tolist()])
+    self.assertFalse(numpy.shares_memory(chunks[0][1], chunks[1][1]))
+    chunks = list(_chunked(((i, data[i]) for i in (2, 4, 5)), 2, False))
+    self.assertEqual([k.tolist() for k in chunks],
+                     [data[[2, 4]].tolist(), data[[5]].tolist()])
+    self.assertEqual(len(list(_chunked(enumerate(data[:6]), 3, False))), 2)
+    self.assertEqual(list(_chunked(iter(()), 3, True)), [])
+
+  def test04_frame_indices(self):
+
+    from .video import frame_indices
+    self.assertEqual(frame_indices(10), None)
+
+    # indices, possibly negative
+    self.assertEqual(frame_indices(10, [3, -1, 0, -10]).tolist(), [3, 9, 0, 0])
+    self.assertEqual(frame_indices(10, 4).tolist(), [4])
+    self.assertEqual(frame_indices(10, []).tolist(), [])
+    self.assertEqual(frame_indices(10, slice(None, None, -4)).tolist(), [9, 5, 1])
+    self.assertEqual(frame_indices(10, slice(-3, 20)).tolist(), [7, 8, 9])
+    self.assertRaises(RuntimeError, frame_indices, 10, [0, 10])
+    self.assertRaises(RuntimeError, frame_indices, 10, [-11])
+    self.assertRaises(RuntimeError, frame_indices, 0, [0])
+
+    # uniformly spaced frames
+    self.assertEqual(frame_indices(10, nframes=4).tolist(), [0, 3, 6, 9])
+    self.assertEqual(frame_indices(10, nframes=1).tolist(), [0])
+    self.assertEqual(frame_indices(10, nframes=0).tolist(), [])
+    self.assertEqual(frame_indices(3, nframes=5).tolist(), [0, 1, 2])
+    self.assertEqual(frame_indices(0, nframes=5).tolist(), [])
+    self.assertRaises(RuntimeError, frame_indices, 10, nframes=-1)
+
+    self.assertRaises(RuntimeError, frame_indices, 10, [1], 2)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Utilities shared by the modules of this package.
+"""
+
+import os
+import tempfile
+import numpy
+
+
+def umask():
+  """Returns the file mode creation mask of the process"""
+
+  retval = os.umask(0)
+  os.umask(retval)
+  return retval
+
+
+def save_atomic(filename, data):
+  """Saves an array in NumPy format so that concurrent readers either see
+  the previous or the new file, never a partially written one"""
+
+  dirname = os.path.dirname(filename)
+  if dirname and not os.path.exists(dirname):
+    try:
+      os.makedirs(dirname)
+    except OSError:  # created concurrently
+      if not os.path.isdir(dirname):
+        raise
+
+  fd, tmp = tempfile.mkstemp(dir=dirname or '.', suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      numpy.save(f, data)
+    os.chmod(tmp, 0o666 & ~umask())  # mkstemp() creates private files
+    os.rename(tmp, filename)
+  except Exception:
+    os.unlink(tmp)
+    raise
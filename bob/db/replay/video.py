@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Memory-conscious access to the videos of the Replay-Attack database.
+"""
+
+import numpy
+import bob.io.base
+import bob.io.video
+
+
+def frame_indices(n_frames, frames=None, nframes=None):
+  """Resolves a selection of frames into an array of frame indices
+
+  Keyword parameters:
+
+  n_frames
+    The total number of frames in the video
+
+  frames
+    [optional] Either a :py:class:`slice` (e.g. ``slice(None, None, 10)`` for
+    every 10th frame) or a sequence of (possibly negative) frame indices
+
+  nframes
+    [optional] The number of uniformly spaced frames to select, including the
+    first and the last frames of the video. If the video has less frames,
+    all of them are selected.
+
+  Returns a 1D :py:class:`numpy.ndarray` with the selected indices, which is
+  ``None`` if neither ``frames`` nor ``nframes`` are set (i.e., all frames
+  are selected).
+  """
+
+  if frames is not None and nframes is not None:
+    raise RuntimeError("Frames may be selected either with `frames' or with `nframes', but not with both")
+
+  if nframes is not None:
+    if nframes < 0:
+      raise RuntimeError("The number of frames to select must not be negative, but got %d" % nframes)
+    if nframes >= n_frames:
+      return numpy.arange(n_frames)
+    return numpy.linspace(0, n_frames - 1, nframes).round().astype(int)
+
+  if frames is None:
+    return None
+
+  if isinstance(frames, slice):
+    return numpy.arange(n_frames)[frames]
+
+  indices = numpy.array(frames, dtype=int).reshape(-1)
+  if len(indices) and (indices.min() < -n_frames or indices.max() >= n_frames):
+    raise RuntimeError("Frame indices must lie within [-%d, %d), but got %s" % (n_frames, n_frames, frames))
+  return numpy.where(indices < 0, indices + n_frames, indices)
+
+
+def _selected(video, indices):
+  """Yields the (index, frame) pairs of a video whose index is in the
+  (sorted, unique) ``indices``, stopping after the last one"""
+
+  if indices is None:
+    for k in enumerate(video):
+      yield k
+    return
+
+  if not len(indices):
+    return
+
+  wanted = set(indices.tolist())
+  last = indices[-1]
+  for i, frame in enumerate(video):
+    if i in wanted:
+      yield i, frame
+    if i == last:
+      break
+
+
+def _chunked(frames, chunk, with_index):
+  """Groups an iterable of frames in arrays of at most ``chunk`` frames
+
+  ``frames`` yields (index, frame) pairs. A new array is allocated for every
+  chunk, so that consumers may keep references to previous chunks.
+  """
+
+  buffer = None
+  start = None
+  n = 0
+  for i, frame in frames:
+    if buffer is None:
+      buffer = numpy.empty((chunk,) + frame.shape, dtype=frame.dtype)
+      start = i
+    buffer[n] = frame
+    n += 1
+    if n == chunk:
+      yield (start, buffer) if with_index else buffer
+      buffer = None
+      n = 0
+  if n:
+    yield (start, buffer[:n]) if with_index else buffer[:n]
+
+
+def iter_frames(filename, chunk=None, with_index=False, frames=None,
+                nframes=None):
+  """Yields the frames of a video file, decoding them one at a time
+
+  Contrary to loading the whole video at once, peak memory usage is bounded
+  by the chunk size and the first frames are available as soon as they are
+  decoded.
+
+  Keyword parameters:
+
+  filename
+    The path to the video file
+
+  chunk
+    If not set (the default), frames are yielded one by one as
+    :py:class:`numpy.ndarray` objects with shape ``(3, height, width)``.
+    Otherwise, frames are grouped in arrays with shape ``(chunk, 3, height,
+    width)``; the last array may contain less frames.
+
+  with_index
+    If set, yields tuples containing the index of the (first) frame and the
+    frame (or chunk), instead of the frames (or chunks) alone. With a frame
+    selection, indices of frames in a chunk are not necessarily contiguous.
+
+  frames, nframes
+    An optional selection of frames, as defined by :py:func:`frame_indices`.
+    Selected frames are yielded in increasing order, each one once.
+    Decoding stops after the last selected frame.
+  """
+
+  for k in iter_video(bob.io.video.reader(filename), chunk, with_index,
+                      frames, nframes):
+    yield k
+
+
+def iter_video(video, chunk=None, with_index=False, frames=None,
+               nframes=None):
+  """Yields the frames of a video which is already open, with the same
+  semantics as :py:func:`iter_frames`
+
+  ``video`` is a :py:class:`bob.io.video.reader`. This avoids opening the
+  file again when its number of frames was needed beforehand.
+  """
+
+  indices = frame_indices(len(video), frames, nframes)
+  if indices is not None:
+    indices = numpy.unique(indices)
+
+  selected = _selected(video, indices)
+
+  if chunk:
+    for k in _chunked(selected, chunk, with_index):
+      yield k
+    return
+
+  for i, frame in selected:
+    yield (i, frame) if with_index else frame
+
+
+def load_frames(filename, frames=None, nframes=None):
+  """Loads a selection of frames from a video file
+
+  Only the selected frames are copied into the returned array. Decoding stops
+  after the last selected frame.
+
+  Keyword parameters:
+
+  filename
+    The path to the video file
+
+  frames, nframes
+    The selection of frames, as defined by :py:func:`frame_indices`. Frames
+    are returned in the order of the selection (indices may repeat).
+
+  Returns a :py:class:`numpy.ndarray` with shape ``(n, 3, height, width)``.
+  If the video holds less frames than its header tells, selected frames that
+  could not be decoded are left out.
+  """
+
+  video = bob.io.video.reader(filename)
+  indices = frame_indices(len(video), frames, nframes)
+  if indices is None:
+    indices = numpy.arange(len(video))
+
+  # output positions of every selected frame
+  positions = {}
+  for p, i in enumerate(indices.tolist()):
+    positions.setdefault(i, []).append(p)
+
+  retval = None
+  written = numpy.zeros(len(indices), dtype=bool)
+  for i, frame in _selected(video, numpy.unique(indices)):
+    if retval is None:
+      retval = numpy.empty((len(indices),) + frame.shape, dtype=frame.dtype)
+    retval[positions[i]] = frame
+    written[positions[i]] = True
+
+  if retval is None:  # no frames selected or decoded
+    return numpy.empty((0, 3, video.height, video.width), dtype=numpy.uint8)
+  if not written.all():  # the stream ended early
+    retval = retval[written]
+  return retval
+
+
+def iter_array(data, chunk=None, with_index=False, frames=None, nframes=None):
+  """Yields the frames of a video already loaded in memory, with the same
+  semantics as :py:func:`iter_frames`"""
+
+  indices = frame_indices(len(data), frames, nframes)
+
+  if indices is None:  # all frames, as views
+    if chunk:
+      for start in range(0, len(data), chunk):
+        yield (start, data[start:start + chunk]) if with_index else \
+            data[start:start + chunk]
+      return
+    for i, frame in enumerate(data):
+      yield (i, frame) if with_index else frame
+    return
+
+  indices = numpy.unique(indices)
+
+  if chunk:
+    for start in range(0, len(indices), chunk):
+      k = indices[start:start + chunk]
+      yield (int(k[0]), data[k]) if with_index else data[k]
+    return
+
+  for i in indices.tolist():
+    yield (i, data[i]) if with_index else data[i]